@@ -1,6 +1,11 @@
 #!/usr/bin/env python
+import sys
 import curses
 from curse_menu import *
 
 if __name__=="__main__":
+	# With a job file on the command line, run it headless instead of opening the menus
+	if len(sys.argv) > 1:
+		import batch
+		sys.exit(batch.main(sys.argv[1:]))
 	curses.wrapper(MyApp)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Execution backends for reducing light frames.
+Every backend hands out a pool with the multiprocessing.Pool calls the
+reducer uses (imap_unordered, apply_async, terminate, join) and runs the
+same worker functions, so they only differ in where the work happens:
+
+	serial      in the calling thread, one chunk at a time
+	threads     a thread pool in this process; numpy and file I/O release
+	            the GIL, and the masters are shared by reference
+	processes   a process pool, with the masters copied to each worker
+	            when it starts
+	shared      a process pool, with the masters published once as
+	            memory-mapped files (see sharedcal.py)
+
+Process workers ignore Ctrl-C; the parent stops feeding them instead.
+"""
+import signal
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+def init_process(initializer, initargs):
+	# Ctrl-C is the parent's to handle; workers just finish what they were given
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	if initializer!=None:
+		initializer(*initargs)
+
+class serialResults(object):
+	def __init__(self, func, iterable):
+		self.func = func
+		self.tasks = iter(iterable)
+
+	def __iter__(self):
+		return self
+
+	def next(self, timeout=None):
+		# Each result is worked out when asked for, so there's nothing to wait on
+		return self.func(next(self.tasks))
+
+class serialPool(object):
+	def __init__(self, initializer=None, initargs=()):
+		if initializer!=None:
+			initializer(*initargs)
+
+	def imap_unordered(self, func, iterable):
+		return serialResults(func, iterable)
+
+	def apply_async(self, func, args=(), callback=None):
+		result = func(*args)
+		if callback!=None:
+			callback(result)
+
+	def terminate(self):
+		pass
+
+	def join(self):
+		pass
+
+class serialBackend(object):
+	name = "serial"
+	processes = False
+	shared = False
+	max_workers = 1
+
+	def pool(self, workers, initializer, initargs):
+		return serialPool(initializer, initargs)
+
+class threadBackend(object):
+	name = "threads"
+	processes = False
+	shared = False
+	max_workers = None
+
+	def pool(self, workers, initializer, initargs):
+		return ThreadPool(workers, initializer, initargs)
+
+class processBackend(object):
+	name = "processes"
+	processes = True
+	shared = False
+	max_workers = None
+
+	def pool(self, workers, initializer, initargs):
+		return Pool(workers, init_process, (initializer, initargs))
+
+class sharedBackend(processBackend):
+	name = "shared"
+	shared = True
+
+BACKENDS = dict((backend.name, backend()) for backend in (serialBackend, threadBackend, processBackend, sharedBackend))
+BACKEND_NAMES = ("serial", "threads", "processes", "shared")
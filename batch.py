@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Headless batch runner for cron jobs and compute nodes.
+Drives the same reducer methods as the curses menus from a JSON job file,
+without asking anything. A job file is either a single job or a list of
+jobs sharing some defaults, e.g.
+
+	{"defaults": {"workers": 8, "precision": "float32"},
+	 "jobs": [{"name": "2016-03-01",
+	           "calibration": {"bias": "/data/0301/cal", "dark": "/data/0301/cal",
+	                           "flat": "/data/0301/cal", "save": true},
+	           "lights": [{"path": "/data/0301/m31", "object": "M31", "filter": "R"}]}]}
+
+Each job gets a fresh reducer, so one bad night doesn't affect the rest.
+A job's "report" names a file its timing report is appended to, and the
+same report is included in the summary. Unless "workers" or "chunksize"
+are given, they are chosen for each light set to fit in "memory_budget"
+(MB, default most of the free memory). Small lights of one shape are
+corrected in blocks of up to "block_budget" MB, 0 for one at a time.
+"backend" picks where lights are reduced, see backends.py.
+"check_precision" compares that many frames of each light set against
+float64 masters rebuilt from the raw calibration frames (or float64
+copies of the ones loaded from "masters").
+A JSON summary of every job is written to stdout (or --summary) and the
+exit status is the worst of the job results, see EXIT_CODES.
+	$ python batch.py nights.json --summary summary.json
+"""
+import sys
+import json
+import time
+import argparse
+from os.path import isdir, join
+import reducer
+from combine import COMBINE_MODES
+
+EXIT_OK = 0
+EXIT_PARTIAL = 1
+EXIT_USAGE = 2
+EXIT_FAILED = 3
+EXIT_CODES = {"ok":EXIT_OK, "partial":EXIT_PARTIAL, "failed":EXIT_FAILED}
+
+JOB_DEFAULTS = {
+	"name":None,
+	"calibration":{},
+	"lights":[],
+	"backend":"shared",
+	"workers":None,
+	"chunksize":None,
+	"memory_budget":None,
+	"block_budget":None,
+	"calib_workers":None,
+	"precision":"float32",
+	"combine_mode":"mean",
+	"combine_sigma":3.0,
+	"strict":False,
+	"check_precision":None,
+	"report":None,
+	"compress":False,
+	"quantize_level":None,
+}
+CALIBRATION_KEYS = ("masters", "bias", "dark", "flat", "save")
+LIGHT_KEYS = ("path", "object", "exposure", "filter")
+
+class jobError(ValueError):
+	pass
+
+def native(node):
+	# json gives unicode strings, the catalog and astropy headers give str
+	if isinstance(node, dict):
+		return dict((native(key), native(node[key])) for key in node)
+	if isinstance(node, list):
+		return [native(value) for value in node]
+	if isinstance(node, unicode):
+		return node.encode("utf-8")
+	return node
+
+def check_job(job, number):
+	unknown = sorted(set(job) - set(JOB_DEFAULTS))
+	if len(unknown)!=0:
+		raise jobError("Job {}: unknown keys {}".format(number, ", ".join(unknown)))
+	if job["precision"] not in reducer.PRECISIONS:
+		raise jobError("Job {}: precision must be one of {}".format(number, ", ".join(reducer.PRECISIONS)))
+	if job["backend"] not in reducer.BACKEND_NAMES:
+		raise jobError("Job {}: backend must be one of {}".format(number, ", ".join(reducer.BACKEND_NAMES)))
+	if job["combine_mode"] not in COMBINE_MODES:
+		raise jobError("Job {}: combine_mode must be one of {}".format(number, ", ".join(COMBINE_MODES)))
+	unknown = sorted(set(job["calibration"]) - set(CALIBRATION_KEYS))
+	if len(unknown)!=0:
+		raise jobError("Job {}: unknown calibration keys {}".format(number, ", ".join(unknown)))
+	for light in job["lights"]:
+		if "path" not in light:
+			raise jobError("Job {}: every lights entry needs a path".format(number))
+		unknown = sorted(set(light) - set(LIGHT_KEYS))
+		if len(unknown)!=0:
+			raise jobError("Job {}: unknown lights keys {}".format(number, ", ".join(unknown)))
+
+def load_jobs(filename):
+	with open(filename) as f:
+		spec = native(json.load(f))
+	if "jobs" in spec:
+		defaults, jobs = spec.get("defaults", {}), spec["jobs"]
+	else:
+		defaults, jobs = {}, [spec]
+	loaded = []
+	for number, job in enumerate(jobs, 1):
+		merged = dict(JOB_DEFAULTS)
+		merged.update(defaults)
+		merged.update(job)
+		check_job(merged, number)
+		if merged["name"]==None:
+			merged["name"] = "job {}".format(number)
+		loaded.append(merged)
+	return loaded
+
+def valid_path(path):
+	if not isdir(path):
+		raise reducer.reducer.reduceError("\"{}\" is not a valid file path".format(path))
+	return path
+
+def reduce_lights(datareducer, light, check_precision=None):
+	datareducer.light_path = valid_path(light["path"])
+	exposure = light.get("exposure")
+	match = (light.get("object"), str(exposure) if exposure!=None else None, light.get("filter"))
+	started = time.time()
+	results = datareducer.red_light(match)
+	corrected = join(datareducer.light_path, "Corrected", "")
+	failed = [result for result in results if not result.startswith(corrected)]
+	summary = {"path":light["path"], "match":list(match), "frames":len(results), "reduced":len(results) - len(failed), "failed":failed,
+		"cancelled":datareducer.cancelled, "schedule":datareducer.schedule, "seconds":time.time() - started}
+	if check_precision and not datareducer.cancelled:
+		summary["precision"] = datareducer.check_precision(match, check_precision)
+	return summary
+
+def run_job(job):
+	summary = {"name":job["name"], "status":"ok", "errors":[], "warnings":[], "masters":{}, "lights":[]}
+	started = time.time()
+	datareducer = reducer.reducer()
+	datareducer.instrument.report_path = job["report"]
+	datareducer.precision = job["precision"]
+	datareducer.backend = job["backend"]
+	datareducer.combine_mode = job["combine_mode"]
+	datareducer.combine_sigma = job["combine_sigma"]
+	datareducer.compress = job["compress"]
+	datareducer.quantize_level = job["quantize_level"]
+	# Left unset, the worker count and chunk size are picked per light set to fit in memory
+	datareducer.light_workers = job["workers"]
+	datareducer.light_chunksize = job["chunksize"]
+	if job["memory_budget"]!=None:
+		datareducer.memory_budget = int(job["memory_budget"]*2**20)
+	if job["block_budget"]!=None:
+		datareducer.block_budget = int(job["block_budget"]*2**20)
+	if job["calib_workers"]!=None:
+		datareducer.calib_workers = job["calib_workers"]
+	# One timing report for the whole job rather than one per reducer call
+	try:
+		with datareducer.instrument.run(job["name"]):
+			run_steps(datareducer, job, summary)
+	finally:
+		datareducer.close()
+	summary["timing"] = datareducer.instrument.last_report
+	summary["seconds"] = time.time() - started
+	return summary
+
+def run_steps(datareducer, job, summary):
+	calibration = job["calibration"]
+	try:
+		if calibration.get("masters"):
+			summary["masters"]["loaded"] = datareducer.load_calib(valid_path(calibration["masters"]))
+		for key, attribute, generate in (("bias", "bias_path", datareducer.gen_bias), ("dark", "dark_path", datareducer.gen_darks), ("flat", "flat_path", datareducer.gen_flats)):
+			if calibration.get(key):
+				setattr(datareducer, attribute, valid_path(calibration[key]))
+				summary["errors"].extend(generate())
+		summary["masters"]["count"] = datareducer.count_calib()
+		summary["warnings"] = [warning.replace(" Continue anyway?", "") for warning in datareducer.check_calib("ALL")]
+		if len(summary["errors"])!=0 or job["strict"] and len(summary["warnings"])!=0:
+			summary["status"] = "failed"
+		else:
+			if calibration.get("save"):
+				datareducer.save_calib()
+				summary["masters"]["saved"] = True
+			for light in job["lights"]:
+				result = reduce_lights(datareducer, light, job["check_precision"])
+				summary["lights"].append(result)
+				if result["cancelled"]:
+					summary["errors"].append("Cancelled")
+					summary["status"] = "failed"
+					summary["cancelled"] = True
+					break
+				if len(result["failed"])!=0:
+					summary["status"] = "partial"
+	except Exception as e:
+		summary["errors"].append("{}: {}".format(type(e).__name__, e))
+		summary["status"] = "failed"
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Run reduction jobs from a JSON job file without the menus.")
+	parser.add_argument("jobfile")
+	parser.add_argument("--summary", help="write the JSON summary here instead of stdout")
+	parser.add_argument("--stop-on-error", action="store_true", help="don't run the remaining jobs after one fails")
+	args = parser.parse_args(argv)
+	try:
+		jobs = load_jobs(args.jobfile)
+	except (IOError, ValueError) as e:
+		sys.stderr.write("{}\n".format(e))
+		return EXIT_USAGE
+	summaries = []
+	for job in jobs:
+		summary = run_job(job)
+		summaries.append(summary)
+		sys.stderr.write("{}: {} ({:.1f}s)\n".format(summary["name"], summary["status"], summary["seconds"]))
+		if summary.get("cancelled") or args.stop_on_error and summary["status"]=="failed":
+			break
+	status = max([EXIT_OK] + [EXIT_CODES[summary["status"]] for summary in summaries])
+	report = json.dumps({"status":status, "jobs":summaries}, indent=2, sort_keys=True)
+	if args.summary:
+		with open(args.summary, "w") as f:
+			f.write(report + "\n")
+	else:
+		print(report)
+	return status
+
+if __name__=="__main__":
+	sys.exit(main(sys.argv[1:]))
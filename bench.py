@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+Benchmarks discovery, calibration and reduction on synthetic data.
+A dataset of bias, dark, flat and light frames is generated from the
+options given (frame size, BITPIX, counts, exposures, filters) and kept in
+the temp directory for reuse. Each stage is then timed in its own process,
+so the peak memory reported belongs to that stage alone, and the best of
+--repeat runs is kept:
+
+	files cold/warm   catalog scan of the calibration directory
+	gen_bias, gen_darks, gen_flats
+	red_light         once per --backends and --workers value ("auto" is the
+	                  scheduler's pick; serial always has one worker)
+	save_calib
+
+A stage that fails is recorded as failed, with its error, and the rest
+still run; the exit status is 1 if any failed.
+Results are appended to a JSON lines file tagged with the git commit, so
+runs can be compared across commits with --compare. Everything runs
+offline. It needs the reducer's own dependencies: Python 2.7, numpy and
+astropy 1.3 to 2.0 (tested with 2.0.16, the last release for Python 2).
+	$ python bench.py --shape 2048x2048 --workers 1,2,4
+	$ python bench.py --stages red_light --backends serial,threads,shared
+	$ python bench.py --compare HEAD~3
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+import resource
+import argparse
+import tempfile
+import traceback
+import subprocess
+import numpy as np
+from multiprocessing import cpu_count
+from os import listdir, makedirs
+from os.path import join, exists, isfile, getsize, expanduser, dirname, abspath
+from astropy.io import fits
+
+RESULTS_PATH = join(expanduser("~"), ".astroReducer", "bench.jsonl")
+BITPIX_TYPES = {8:np.uint8, 16:np.uint16, 32:np.uint32, -32:np.float32, -64:np.float64}
+STAGES = ("files cold", "files warm", "gen_bias", "gen_darks", "gen_flats", "red_light", "save_calib")
+
+def dataset_params(args):
+	return {"shape":args.shape, "bitpix":args.bitpix, "bias":args.bias, "darks":args.darks, "flats":args.flats,
+		"lights":args.lights, "exposures":args.exposures, "filters":args.filters, "seed":args.seed}
+
+def write_frame(path, data, bitpix, cards):
+	dtype = BITPIX_TYPES[bitpix]
+	if bitpix > 0:
+		data = np.clip(data, 0, np.iinfo(dtype).max)
+	hdu = fits.PrimaryHDU(data.astype(dtype))
+	for card in cards:
+		hdu.header[card] = cards[card]
+	hdu.writeto(path)
+
+def generate(params, root):
+	# Bias + dark current + sky through a vignetted flat, with gaussian noise on top
+	rows, cols = [int(n) for n in params["shape"].split("x")]
+	rs = np.random.RandomState(params["seed"])
+	scale = 0.01 if params["bitpix"] == 8 else 1.0
+	y, x = np.mgrid[0:rows, 0:cols]
+	vignette = 1 - 0.3*(((y - rows/2.0)/rows)**2 + ((x - cols/2.0)/cols)**2)
+	bias = 100*scale
+	cal, lights = join(root, "cal"), join(root, "lights")
+	makedirs(cal)
+	makedirs(lights)
+	noise = lambda sigma: rs.normal(0, sigma*scale, (rows, cols))
+	for i in range(params["bias"]):
+		write_frame(join(cal, "bias_{}.fits".format(i)), bias + noise(3), params["bitpix"], {"IMAGETYP":"BIAS"})
+	for exp in params["exposures"]:
+		for i in range(params["darks"]):
+			write_frame(join(cal, "dark_{}_{}.fits".format(exp, i)), bias + 0.5*exp*scale + noise(3), params["bitpix"], {"IMAGETYP":"DARK", "EXPOSURE":exp})
+	for fil in params["filters"]:
+		for i in range(params["flats"]):
+			write_frame(join(cal, "flat_{}_{}.fits".format(fil, i)), bias + 20000*scale*vignette + noise(100), params["bitpix"], {"IMAGETYP":"Flat Field", "FILTER":fil})
+	for exp in params["exposures"]:
+		for fil in params["filters"]:
+			for i in range(params["lights"]):
+				write_frame(join(lights, "light_{}_{}_{}.fits".format(exp, fil, i)), bias + 0.5*exp*scale + 1000*scale*vignette + noise(30), params["bitpix"],
+					{"IMAGETYP":"LIGHT", "OBJECT":"BENCH", "EXPOSURE":exp, "FILTER":fil})
+
+def dataset(params):
+	# Generated once per set of parameters and reused by later runs
+	key = hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()[:12]
+	root = join(tempfile.gettempdir(), "reducer-bench-{}".format(key))
+	if not exists(join(root, "params.json")):
+		if exists(root):
+			shutil.rmtree(root)
+		generate(params, root)
+		with open(join(root, "params.json"), "w") as f:
+			json.dump(params, f)
+	return root
+
+def directory_stats(path, prefix=""):
+	files = [join(path, f) for f in listdir(path) if isfile(join(path, f)) and f.startswith(prefix) and f.endswith(".fits")]
+	return len(files), sum(getsize(f) for f in files)
+
+def reset_peak():
+	# Linux can reset the high water mark, so setup work doesn't count towards the stage
+	try:
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+	except IOError:
+		pass
+
+def peak_rss():
+	try:
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1])/1024.0
+	except IOError:
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+def new_reducer(engine, root):
+	if engine == "altreduce":
+		import altreduce
+		datareducer = altreduce.reducer()
+	else:
+		import reducer
+		datareducer = reducer.reducer()
+	# A stage served from the master library wouldn't measure anything
+	datareducer.library = None
+	datareducer.bias_path = datareducer.dark_path = datareducer.flat_path = join(root, "cal")
+	datareducer.light_path = join(root, "lights")
+	return datareducer
+
+def measure(stage, engine, root, workers, backend):
+	# Runs in a fresh process; setup isn't timed and, where possible, isn't counted in the peak either
+	cal = join(root, "cal")
+	datareducer = new_reducer(engine, root)
+	calib_workers = getattr(datareducer, "calib_workers", None)
+	if hasattr(datareducer, "calib_workers"):
+		datareducer.calib_workers = 1
+	if stage == "files cold":
+		for f in listdir(cal):
+			if f.startswith(".reducer_catalog"):
+				os.remove(join(cal, f))
+	else:
+		datareducer.files(cal, "BIAS")
+	if stage in ("gen_darks", "gen_flats", "red_light", "save_calib"):
+		datareducer.gen_bias()
+	if stage in ("red_light", "save_calib"):
+		datareducer.gen_darks()
+		datareducer.gen_flats()
+		datareducer.update_cal()
+	if stage == "red_light":
+		datareducer.files(datareducer.light_path, "LIGHT")
+		if exists(join(datareducer.light_path, "Corrected")):
+			shutil.rmtree(join(datareducer.light_path, "Corrected"))
+		if workers != None:
+			datareducer.light_workers = workers
+		if backend != None:
+			datareducer.backend = backend
+	if stage == "save_calib":
+		save = tempfile.mkdtemp(prefix="reducer-bench-save-")
+		datareducer.bias_path = datareducer.dark_path = datareducer.flat_path = save
+	if calib_workers != None:
+		datareducer.calib_workers = calib_workers
+	reset_peak()
+	# Children can't have their peak reset, so it only counts if this stage raised it
+	before = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+	start = time.time()
+	if stage in ("files cold", "files warm"):
+		datareducer.files(cal, "BIAS")
+		frames, size = len(listdir(cal)), 0
+	elif stage == "gen_bias":
+		datareducer.gen_bias()
+		frames, size = directory_stats(cal, "bias_")
+	elif stage == "gen_darks":
+		datareducer.gen_darks()
+		frames, size = directory_stats(cal, "dark_")
+	elif stage == "gen_flats":
+		datareducer.gen_flats()
+		frames, size = directory_stats(cal, "flat_")
+	elif stage == "red_light":
+		datareducer.red_light()
+		frames, size = directory_stats(datareducer.light_path)
+	elif stage == "save_calib":
+		datareducer.save_calib()
+		frames, size = directory_stats(save)
+	elapsed = time.time() - start
+	if stage == "save_calib":
+		shutil.rmtree(save)
+	# The light pool outlives red_light, and its workers only count towards the children's peak once reaped
+	datareducer.close()
+	children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+	return {"seconds":elapsed, "frames":frames, "bytes":size, "peak MB":peak_rss(), "worker peak MB":children/1024.0 if children > before else None}
+
+def run_stage(stage, engine, root, workers, backend):
+	command = [sys.executable, abspath(__file__), "--measure", stage, "--engine", engine, "--root", root]
+	if workers != None:
+		command += ["--worker-count", str(workers)]
+	if backend != None:
+		command += ["--backend", backend]
+	process = subprocess.Popen(command, stdout=subprocess.PIPE)
+	output = process.communicate()[0]
+	try:
+		return json.loads(output.strip().split("\n")[-1])
+	except ValueError:
+		# Died without reporting, e.g. killed for running out of memory
+		return {"failed":"exit status {}".format(process.returncode)}
+
+def best_of(stage, engine, root, workers, backend, repeat):
+	runs = []
+	for i in range(repeat):
+		runs.append(run_stage(stage, engine, root, workers, backend))
+		if "failed" in runs[-1]:
+			return runs[-1]
+	best = min(runs, key=lambda run: run["seconds"])
+	result = dict(best)
+	result["peak MB"] = max(run["peak MB"] for run in runs)
+	result["worker peak MB"] = max(run["worker peak MB"] for run in runs)
+	result["frames per second"] = best["frames"]/best["seconds"] if best["seconds"] > 0 else None
+	result["MB per second"] = best["bytes"]/2.0**20/best["seconds"] if best["seconds"] > 0 else None
+	return result
+
+def git_commit():
+	here = dirname(abspath(__file__))
+	try:
+		with open(os.devnull, "w") as null:
+			commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=here, stderr=null).strip()
+			dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here, stderr=null).strip() != ""
+	except (OSError, subprocess.CalledProcessError):
+		return None, False
+	return commit, dirty
+
+def resolve_commit(rev):
+	try:
+		with open(os.devnull, "w") as null:
+			return subprocess.check_output(["git", "rev-parse", rev], cwd=dirname(abspath(__file__)), stderr=null).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return rev
+
+def load_results(path):
+	results = []
+	if exists(path):
+		with open(path) as f:
+			for line in f:
+				if line.strip():
+					results.append(json.loads(line))
+	return results
+
+def compare(current, results, rev):
+	commit = resolve_commit(rev)
+	previous = [r for r in results if r["commit"] != None and r["commit"].startswith(commit)
+		and r["dataset"] == current["dataset"] and r["engine"] == current["engine"]]
+	if len(previous) == 0:
+		print("No stored results for {} with the same dataset".format(rev))
+		return
+	baseline = previous[-1]["stages"]
+	print("Compared with {} ({}):".format(rev, previous[-1]["date"]))
+	for name in sorted(current["stages"]):
+		if name in baseline and "failed" not in baseline[name] and "failed" not in current["stages"][name]:
+			print("{:>24}: {:.3f}s -> {:.3f}s ({:+.1f}%)".format(name, baseline[name]["seconds"], current["stages"][name]["seconds"],
+				100.0*(current["stages"][name]["seconds"]/baseline[name]["seconds"] - 1) if baseline[name]["seconds"] > 0 else 0))
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Benchmark the reducer on synthetic FITS data.")
+	parser.add_argument("--shape", default="1024x1024", help="frame size as ROWSxCOLS")
+	parser.add_argument("--bitpix", type=int, default=16, choices=sorted(BITPIX_TYPES))
+	parser.add_argument("--bias", type=int, default=10, help="bias frames")
+	parser.add_argument("--darks", type=int, default=5, help="dark frames per exposure")
+	parser.add_argument("--flats", type=int, default=5, help="flat frames per filter")
+	parser.add_argument("--lights", type=int, default=5, help="light frames per exposure and filter")
+	parser.add_argument("--exposures", default="10,30")
+	parser.add_argument("--filters", default="R,V")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--workers", default="1,2,4", help="light worker counts for red_light, or auto")
+	parser.add_argument("--backends", default="shared", help="light backends for red_light: serial, threads, processes, shared")
+	parser.add_argument("--stages", default=",".join(STAGES))
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--engine", default="reducer", choices=("reducer", "altreduce"))
+	parser.add_argument("--results", default=RESULTS_PATH, help="JSON lines file the results are appended to")
+	parser.add_argument("--no-save", action="store_true", help="don't store this run")
+	parser.add_argument("--compare", help="git revision to compare with")
+	parser.add_argument("--measure", help=argparse.SUPPRESS)
+	parser.add_argument("--root", help=argparse.SUPPRESS)
+	parser.add_argument("--worker-count", type=int, help=argparse.SUPPRESS)
+	parser.add_argument("--backend", help=argparse.SUPPRESS)
+	args = parser.parse_args(argv)
+	if args.measure:
+		try:
+			result = measure(args.measure, args.engine, args.root, args.worker_count, args.backend)
+		except Exception as e:
+			# Reported like a result, so the stage is recorded as failed and the benchmark carries on
+			traceback.print_exc()
+			result = {"failed":"{}: {}".format(type(e).__name__, e)}
+		print(json.dumps(result))
+		return 1 if "failed" in result else 0
+	args.exposures = [float(e) for e in args.exposures.split(",")]
+	args.filters = args.filters.split(",")
+	params = dataset_params(args)
+	root = dataset(params)
+	commit, dirty = git_commit()
+	current = {"commit":commit, "dirty":dirty, "date":time.strftime("%Y-%m-%dT%H:%M:%S"), "engine":args.engine, "dataset":params,
+		"host":platform.node(), "cpus":cpu_count(),
+		"python":platform.python_version(), "numpy":np.__version__, "stages":{}}
+	for stage in args.stages.split(","):
+		runs = [(stage, None, None)]
+		if stage == "red_light" and args.engine == "reducer":
+			runs = []
+			for backend in args.backends.split(","):
+				# The shared backend keeps the names results were stored under before there were backends
+				prefix = "red_light" if backend == "shared" else "red_light {}".format(backend)
+				if backend == "serial":
+					runs.append((prefix, 1, backend))
+				else:
+					runs.extend(("{} x{}".format(prefix, w), None if w == "auto" else int(w), backend) for w in args.workers.split(","))
+		for name, workers, backend in runs:
+			result = best_of(stage, args.engine, root, workers, backend, args.repeat)
+			current["stages"][name] = result
+			if "failed" in result:
+				print("{:>24}: failed ({})".format(name, result["failed"]))
+				sys.stdout.flush()
+				continue
+			workers_peak = "{:.0f} MB".format(result["worker peak MB"]) if result["worker peak MB"]!=None else "-"
+			print("{:>24}: {:8.3f}s {:8.1f} frames/s {:8.1f} MB/s  peak {:.0f} MB (workers {})".format(name, result["seconds"],
+				result["frames per second"] or 0, result["MB per second"] or 0, result["peak MB"], workers_peak))
+			sys.stdout.flush()
+	if not args.no_save:
+		if not exists(dirname(args.results)):
+			makedirs(dirname(args.results))
+		with open(args.results, "a") as f:
+			f.write(json.dumps(current, sort_keys=True) + "\n")
+	if args.compare:
+		compare(current, load_results(args.results)[:-1] if not args.no_save else load_results(args.results), args.compare)
+	return 1 if any("failed" in result for result in current["stages"].values()) else 0
+
+if __name__=="__main__":
+	sys.exit(main(sys.argv[1:]))
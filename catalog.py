@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+On-disk catalog of FITS header fields for a data directory.
+Headers are read once and cached in a SQLite file keyed by filename, size and
+mtime, so repeated scans of the same directory only touch changed files.
+"""
+import os
+import sqlite3
+import hashlib
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+from os import listdir, makedirs
+from os.path import isfile, isdir, join, exists, abspath, expanduser
+import fitshead
+
+CATALOG_NAME = ".reducer_catalog.sqlite"
+CACHE_DIR = join(expanduser("~"), ".astroReducer", "catalogs")
+SCHEMA_VERSION = 1
+SCAN_THREADS = 8
+
+KEYWORDS = ("IMAGETYP", "OBJECT", "EXPOSURE", "EXPTIME", "FILTER", "BITPIX", "NAXIS1", "NAXIS2")
+COLUMNS = ("filename", "size", "mtime", "imagetyp", "object", "exposure", "filter", "bitpix", "naxis1", "naxis2")
+
+def header_value(value):
+	# Only what sqlite can store; a card with a blank value (astropy's Undefined) counts as missing
+	if isinstance(value, (str, unicode, bool, int, long, float)):
+		return value
+	return None
+
+def integer_value(value):
+	if isinstance(value, (int, long)) and not isinstance(value, bool):
+		return value
+	return None
+
+class catalog(object):
+	def __init__(self, path, threads=SCAN_THREADS):
+		self.path = abspath(path)
+		self.threads = threads
+		if os.access(self.path, os.W_OK):
+			self.dbfile = join(self.path, CATALOG_NAME)
+		else:
+			# Read-only data (e.g. an archive mount) keeps its catalog in the user's home instead
+			if not exists(CACHE_DIR):
+				makedirs(CACHE_DIR)
+			self.dbfile = join(CACHE_DIR, "{}.sqlite".format(hashlib.sha1(self.path).hexdigest()))
+
+	def __connect(self):
+		conn = sqlite3.connect(self.dbfile)
+		conn.text_factory = str
+		if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+			conn.execute("DROP TABLE IF EXISTS frames")
+			conn.execute("CREATE TABLE frames (filename TEXT PRIMARY KEY, size INTEGER, mtime REAL, imagetyp TEXT, object TEXT, exposure TEXT, filter TEXT, bitpix INTEGER, naxis1 INTEGER, naxis2 INTEGER)")
+			conn.execute("CREATE INDEX frames_match ON frames (imagetyp, object, exposure, filter)")
+			conn.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+			conn.commit()
+		return conn
+
+	def listing(self):
+		entries = {}
+		for f in listdir(self.path):
+			if f.startswith(CATALOG_NAME):
+				continue
+			full = join(self.path, f)
+			if not isfile(full):
+				continue
+			st = os.stat(full)
+			entries[f] = (st.st_size, st.st_mtime)
+		return entries
+
+	def refresh(self):
+		entries = self.listing()
+		with closing(self.__connect()) as conn:
+			known = dict((row[0], (row[1], row[2])) for row in conn.execute("SELECT filename, size, mtime FROM frames"))
+			gone = [(f,) for f in known if f not in entries]
+			stale = [f for f in entries if known.get(f) != entries[f]]
+			conn.executemany("DELETE FROM frames WHERE filename=?", gone)
+			insert = "INSERT OR REPLACE INTO frames VALUES ({})".format(",".join("?"*len(COLUMNS)))
+			for row in self.scan_headers([(f, entries[f]) for f in stale]):
+				conn.execute(insert, row)
+			conn.commit()
+		return len(stale)
+
+	def scan_headers(self, stale):
+		# Header reads are latency bound, so a few threads hide most of the open/read round trips.
+		# Rows are yielded in order of completion.
+		if self.threads <= 1 or len(stale) <= 1:
+			for f, stat in stale:
+				yield self.read_header(f, stat)
+			return
+		pool = ThreadPool(min(self.threads, len(stale)))
+		try:
+			for row in pool.imap_unordered(self.read_stale, stale):
+				yield row
+		finally:
+			pool.terminate()
+			pool.join()
+
+	def read_stale(self, (filename, stat)):
+		return self.read_header(filename, stat)
+
+	def read_header(self, filename, (size, mtime)):
+		# Any file whose header can't be read or parsed is catalogued as unreadable rather than failing the scan
+		try:
+			header = fitshead.getheader(join(self.path, filename), KEYWORDS)
+			if "EXPOSURE" in header:
+				exposure = header_value(header["EXPOSURE"])
+			elif "EXPTIME" in header:
+				exposure = header_value(header["EXPTIME"])
+			else:
+				exposure = None
+			return (filename, size, mtime,
+				header_value(header.get("IMAGETYP")), header_value(header.get("OBJECT")), str(exposure) if exposure!=None else None,
+				header_value(header.get("FILTER")), integer_value(header.get("BITPIX")), integer_value(header.get("NAXIS1")), integer_value(header.get("NAXIS2")))
+		except Exception:
+			return (filename, size, mtime, None, None, None, None, None, None, None)
+
+	def query(self, filetype, obj=None, exp=None, fil=None):
+		sql = "SELECT filename FROM frames WHERE imagetyp=?"
+		args = [filetype]
+		if obj!=None:
+			sql += " AND object=?"
+			args.append(obj)
+		if exp!=None:
+			# Frames with no exposure keyword at all have always passed an exposure match
+			sql += " AND (exposure IS NULL OR exposure=?)"
+			args.append(exp)
+		if fil!=None:
+			sql += " AND filter=?"
+			args.append(fil)
+		sql += " ORDER BY filename"
+		with closing(self.__connect()) as conn:
+			return [row[0] for row in conn.execute(sql, args)]
+
+	def inventory(self):
+		with closing(self.__connect()) as conn:
+			rows = conn.execute("SELECT {} FROM frames ORDER BY filename".format(", ".join(COLUMNS))).fetchall()
+		return inventory(self.path, [dict(zip(COLUMNS, row)) for row in rows])
+
+class inventory(object):
+	"""Every frame of one directory scan, with the header fields the reducer matches on."""
+	def __init__(self, path, frames):
+		self.path = path
+		self.frames = frames
+		for frame in self.frames:
+			frame["path"] = join(self.path, frame["filename"])
+
+	def select(self, filetype, (obj, exp, fil) = (None, None, None)):
+		return [frame for frame in self.frames if frame["imagetyp"]==filetype
+			and (obj==None or frame["object"]==obj)
+			and (exp==None or frame["exposure"]==None or frame["exposure"]==exp)
+			and (fil==None or frame["filter"]==fil)]
+
+	def files(self, filetype, match=(None, None, None)):
+		return [frame["filename"] for frame in self.select(filetype, match)]
+
+	def group(self, filetype, *fields):
+		groups = {}
+		for frame in self.select(filetype):
+			if len(fields)==1:
+				key = frame[fields[0]]
+			else:
+				key = tuple(frame[field] for field in fields)
+			groups.setdefault(key, []).append(frame)
+		return groups
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Combine engines for building master calibration frames.
+Frames are memory-mapped with their raw on-disk values, and BSCALE/BZERO
+are applied while accumulating, so a stack of any length only costs one
+accumulator (plus one read buffer for scaled data). 32-bit integer and
+double frames are accumulated in float64 whatever the precision, as their
+raw values (unsigned 32-bit data sits around -2**31 before BZERO) don't
+survive float32.
+
+Median and sigma-clipped combines can't be streamed, so they work on row
+tiles of the stack sized to fit a memory budget. Unlike mean stacks, they
+can't be updated with new frames and are recombined from scratch.
+"""
+import numpy as np
+from os.path import getsize
+from multiprocessing.pool import ThreadPool
+from astropy.io import fits
+from instrument import instrument
+from fitshead import image_hdu
+from scheduler import work_dtype
+
+COMBINE_MODES = ("mean", "median", "sigma clip")
+COMBINE_BUDGET = 256*2**20
+
+class combineError(RuntimeError):
+	def __init__(self, errors):
+		self.errors = errors
+
+	def __str__(self):
+		return "Error: {}".format(repr(self.errors))
+
+def open_frame(path):
+	hdul = fits.open(path, memmap=True, do_not_scale_image_data=True)
+	hdu = image_hdu(hdul)
+	return hdul, hdu.data, hdu.header.get("BSCALE", 1), hdu.header.get("BZERO", 0)
+
+def frame_dtype(raw, dtype):
+	# The dtype a raw frame is combined in, by the same rule the lights are corrected with
+	bitpix = raw.dtype.itemsize*8 * (-1 if raw.dtype.kind == "f" else 1)
+	return work_dtype(bitpix, dtype)
+
+def sum_frames(paths, dtype=np.float64):
+	acc = None
+	buf = None
+	for path in paths:
+		hdul, raw, bscale, bzero = open_frame(path)
+		try:
+			if acc is None:
+				acc = np.zeros(raw.shape, frame_dtype(raw, dtype))
+			elif raw.shape != acc.shape:
+				raise combineError("{} has shape {}, expected {}".format(path, raw.shape, acc.shape))
+			elif frame_dtype(raw, dtype).itemsize > acc.dtype.itemsize:
+				acc = acc.astype(frame_dtype(raw, dtype))
+				buf = None
+			if bscale == 1:
+				np.add(acc, raw, out=acc, casting="unsafe")
+				if bzero != 0:
+					acc += bzero
+			else:
+				if buf is None:
+					buf = np.empty_like(acc)
+				np.multiply(raw, bscale, out=buf, casting="unsafe")
+				buf += bzero
+				acc += buf
+			del raw
+		finally:
+			hdul.close()
+	return acc
+
+def mean_combine(paths, dtype=np.float64):
+	acc = sum_frames(paths, dtype)
+	if acc is not None:
+		acc /= len(paths)
+	return acc
+
+def tile_rows(nframes, shape, dtype, budget, copies=1):
+	row_bytes = nframes * int(np.prod(shape[1:])) * np.dtype(dtype).itemsize * copies
+	return int(max(1, min(shape[0], budget // row_bytes)))
+
+def sigma_clip_mean(cube, sigma=3.0, iters=3):
+	# The spread is the MAD scaled to a gaussian sigma, since a plain std is dragged up by the very
+	# outliers being rejected. Rejected pixels become NaN in place, so the tile never needs a masked copy.
+	with np.errstate(invalid="ignore"):
+		for i in range(iters):
+			center = np.nanmedian(cube, axis=0)
+			dev = cube - center
+			np.abs(dev, out=dev)
+			limit = np.nanmedian(dev, axis=0)
+			limit *= 1.4826*sigma
+			reject = dev > limit
+			del dev
+			if not reject.any():
+				break
+			cube[reject] = np.nan
+		return np.nanmean(cube, axis=0)
+
+def robust_combine(paths, mode="median", dtype=np.float64, budget=COMBINE_BUDGET, sigma=3.0, iters=3, threads=1):
+	frames = []
+	try:
+		for path in paths:
+			frames.append(open_frame(path))
+		shape = frames[0][1].shape
+		for (hdul, raw, bscale, bzero), path in zip(frames, paths):
+			if raw.shape != shape:
+				raise combineError("{} has shape {}, expected {}".format(path, raw.shape, shape))
+		dtype = max((frame_dtype(raw, dtype) for hdul, raw, bscale, bzero in frames), key=lambda d: d.itemsize)
+		# Sigma clipping holds about two more tile-sized temporaries than the stack itself
+		copies = 1 if mode == "median" else 3
+		rows = tile_rows(len(frames), shape, dtype, budget/max(1, threads), copies)
+		out = np.empty(shape, dtype)
+
+		def tile(start):
+			stop = min(start+rows, shape[0])
+			cube = np.empty((len(frames), stop-start) + shape[1:], dtype)
+			for i, (hdul, raw, bscale, bzero) in enumerate(frames):
+				np.copyto(cube[i], raw[start:stop], casting="unsafe")
+				if bscale != 1:
+					cube[i] *= bscale
+				if bzero != 0:
+					cube[i] += bzero
+			if mode == "median":
+				np.median(cube, axis=0, out=out[start:stop])
+			else:
+				out[start:stop] = sigma_clip_mean(cube, sigma, iters)
+
+		starts = range(0, shape[0], rows)
+		if threads > 1 and len(starts) > 1:
+			pool = ThreadPool(min(threads, len(starts)))
+			try:
+				pool.map(tile, starts)
+			finally:
+				pool.terminate()
+				pool.join()
+		else:
+			for start in starts:
+				tile(start)
+		return out
+	finally:
+		for hdul, raw, bscale, bzero in frames:
+			hdul.close()
+
+def combine_frames(paths, mode="mean", dtype=np.float64, budget=COMBINE_BUDGET, sigma=3.0, iters=3, threads=1):
+	if mode == "mean":
+		return mean_combine(paths, dtype)
+	elif mode in ("median", "sigma clip"):
+		return robust_combine(paths, mode, dtype, budget, sigma, iters, threads)
+	else:
+		raise combineError("Unknown combine mode: {}".format(mode))
+
+def stack_frames(paths, mode="mean", dtype=np.float64, budget=COMBINE_BUDGET, sigma=3.0, iters=3, threads=1):
+	# Mean stacks are kept as running sums so more frames can be folded in later
+	if mode == "mean":
+		return sum_frames(paths, dtype)
+	return combine_frames(paths, mode, dtype, budget, sigma, iters, threads)
+
+def stack_result(stack, count, mode="mean"):
+	if mode == "mean":
+		return stack / count
+	return np.array(stack)
+
+def combine_group((kind, tag, paths, mode, dtype, budget, sigma, threads)):
+	timer = instrument()
+	with timer.stage("combine", frames=len(paths), bytes_read=sum(getsize(path) for path in paths)):
+		stack = stack_frames(paths, mode, dtype, budget=budget, sigma=sigma, threads=threads)
+	return kind, tag, stack, timer.collect()
@@ -7,6 +7,7 @@ from astropy.io import fits
 from os import listdir, makedirs
 from os.path import isfile, isdir, join, exists, splitext
 import time
+from scheduler import describe
 
 class Menu(object):
 
@@ -145,6 +146,8 @@ class MyApp(object):
                 ('Select Bias Directory & Generate Master Bias', self.bias),
                 ('Select Dark Directory & Generate Master Darks', self.dark),
 		('Select Flat Directory & Generate Master Flats', self.flat),
+		('Select Calibration Directory & Generate All Masters', self.allcal),
+		('Select Directory & Load Saved Calibration Images', self.loadcal),
 		('Save Calibration Images', self.save)
                 ]
         calibration = Menu(self.cal_items, self.screen, "Calibration Menu", 1)
@@ -193,12 +196,12 @@ class MyApp(object):
                     self.alert("Error: {} doesn't exist.".format(self.filemenu.result))
                     return
                 self.datareducer.flat_path = self.filemenu.result
-                if not self.confirm("Generate flats from \"{}\"? (Screen will go blank until process finishes)".format(self.filemenu.result)):
+                if not self.confirm("Generate flats from \"{}\"? (Progress is shown as each filter finishes)".format(self.filemenu.result)):
                     return
                 for warning in self.datareducer.check_calib("BIAS"):
                     if not self.confirm(warning):
                         return
-                for error in self.datareducer.gen_flats():
+                for error in self.datareducer.gen_flats(progress=self.calib_progress):
                     self.alert(error)
                 return
             else:
@@ -214,18 +217,84 @@ class MyApp(object):
                     self.alert("Error: {} doesn't exist.".format(self.filemenu.result))
                     return
                 self.datareducer.dark_path = self.filemenu.result
-                if not self.confirm("Generate darks from \"{}\"? (Screen will go blank until process finishes)".format(self.filemenu.result)):
+                if not self.confirm("Generate darks from \"{}\"? (Progress is shown as each exposure finishes)".format(self.filemenu.result)):
                     return
                 for warning in self.datareducer.check_calib("BIAS"):
                     if not self.confirm(warning):
                         return
-                for error in self.datareducer.gen_darks():
+                for error in self.datareducer.gen_darks(progress=self.calib_progress):
                     self.alert(error)
                 return
             else:
                 if self.confirm("Do you want to cancel and go back to the menu?"):
                     return
     
+    def allcal(self):
+        while True:
+            self.filemenu.set_title("Select Calibration Directory")
+            self.filemenu.display()
+            if self.filemenu.result != "":
+                if not exists(self.filemenu.result):
+                    self.alert("Error: {} doesn't exist.".format(self.filemenu.result))
+                    return
+                if not self.confirm("Generate bias, darks and flats from \"{}\"? (Progress is shown as each master finishes)".format(self.filemenu.result)):
+                    return
+                self.datareducer.bias_path = self.filemenu.result
+                self.datareducer.dark_path = self.filemenu.result
+                self.datareducer.flat_path = self.filemenu.result
+                for error in self.datareducer.gen_calib(progress=self.calib_progress):
+                    self.alert(error)
+                return
+            else:
+                if self.confirm("Do you want to cancel and go back to the menu?"):
+                    return
+
+    def loadcal(self):
+        while True:
+            self.filemenu.set_title("Select Saved Calibration Directory")
+            self.filemenu.display()
+            if self.filemenu.result != "":
+                if not exists(self.filemenu.result):
+                    self.alert("Error: {} doesn't exist.".format(self.filemenu.result))
+                    return
+                loaded = self.datareducer.load_calib(self.filemenu.result)
+                if len(loaded)==0:
+                    self.alert("No saved calibration images found in {}".format(self.filemenu.result))
+                else:
+                    self.alert("{} calibration images were loaded.".format(len(loaded)))
+                return
+            else:
+                if self.confirm("Do you want to cancel and go back to the menu?"):
+                    return
+
+    def calib_progress(self, kind, tag, done, total):
+        if tag == None:
+            self.status("Master {} finished ({}/{})".format(kind.lower(), done, total))
+        else:
+            self.status("Master {} \"{}\" finished ({}/{})".format(kind.lower(), tag, done, total))
+
+    def light_progress(self, result, done, total):
+        elapsed = time.time() - self.light_started
+        rate = done/elapsed if elapsed > 0 else 0
+        eta = int((total-done)/rate) if rate > 0 else 0
+        y, x = self.screen.getmaxyx()
+        width = max(10, min(50, x-20))
+        filled = width*done/total if total > 0 else width
+        self.screen.clear()
+        self.screen.addstr(1, 1, "Reducing [{}{}] {}/{}".format("#"*filled, "."*(width-filled), done, total)[:x-2])
+        self.screen.addstr(2, 1, "{:.1f} frames/s, {}:{:02d} left".format(rate, eta/60, eta%60)[:x-2])
+        self.screen.addstr(3, 1, result[:x-2])
+        if self.datareducer.schedule!=None:
+            self.screen.addstr(4, 1, describe(self.datareducer.schedule)[:x-2])
+        self.screen.addstr(5, 1, "Press Ctrl-C to cancel"[:x-2])
+        self.screen.refresh()
+
+    def status(self, msg):
+        self.screen.clear()
+        y, x = self.screen.getmaxyx()
+        self.screen.addstr(1, 1, msg[:x-2])
+        self.screen.refresh()
+
     def lightdir(self):
         while True:
             self.filemenu.set_title("Select Data Directory")
@@ -259,8 +328,13 @@ class MyApp(object):
             if not self.confirm(warning):
                 return
         if self.confirm("Corrected images will be stored in \"{}\"".format(join(self.datareducer.light_path,"Corrected"))):
-            allfiles = self.datareducer.red_light(self.obj_criteria)
-	    self.alert("Reduction successful!")
+            self.light_started = time.time()
+            self.status("Starting reduction...")
+            allfiles = self.datareducer.red_light(self.obj_criteria, progress=self.light_progress)
+            if self.datareducer.cancelled:
+                self.alert("Reduction cancelled after {} frames.".format(len(allfiles)))
+            else:
+                self.alert("Reduction successful!")
 
     def selecttarget(self):
         if not self.allowtarget:
@@ -270,23 +344,18 @@ class MyApp(object):
             self.targetname = None
             self.obj_criteria = (None, None, None)
             targets = {}
-            onlyfiles = self.datareducer.files(self.datareducer.light_path, "LIGHT")
-            for filename in onlyfiles:
-                header = fits.getheader(join(self.datareducer.light_path, filename))
-                if "OBJECT" in header:
-                    objkey = header["OBJECT"]
+            inventory = self.datareducer.scan(self.datareducer.light_path)
+            for frame in inventory.select("LIGHT"):
+                if frame["object"] != None:
+                    objkey = frame["object"]
                     if objkey not in targets:
                         targets[objkey]={"exp":{},"f":{}}
-                    if "EXPOSURE" in header:
-                        expkey = str(header["EXPOSURE"])
-                        if expkey not in targets[objkey]["exp"]:
-                            targets[objkey]["exp"][expkey] = True
-                    elif "EXPTIME" in header:
-                        expkey = str(header["EXPTIME"])
+                    if frame["exposure"] != None:
+                        expkey = frame["exposure"]
                         if expkey not in targets[objkey]["exp"]:
                             targets[objkey]["exp"][expkey] = True
-                    if "FILTER" in header:
-                        fkey = header["FILTER"]
+                    if frame["filter"] != None:
+                        fkey = frame["filter"]
                         if fkey not in targets[objkey]:
                             targets[objkey]["f"][fkey] = True
             names = []
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Per-stage timing for the reducer.
+Each stage (scan, combine, normalise, read, correct, convert, write...)
+adds up its wall time, calls, frames and bytes. Worker processes keep
+their own instrument and hand back what they collected with each result,
+so per-worker numbers survive the process boundary; stage seconds from
+workers are therefore summed over workers, not wall time.
+
+At the end of a run the totals become a JSON-ready report. It is passed
+to every hook and, with report_path set, appended to that file as one
+JSON object per line. Decisions made along the way, like the worker
+schedule, can be noted and are kept in the report's "notes". Hooks are
+called as hook(event, data), where event is "stage" with a (name, record)
+tuple, "note" with a (name, value) tuple or "report" with the report.
+"""
+import os
+import json
+import time
+from contextlib import contextmanager
+
+STAGE_FIELDS = ("calls", "seconds", "frames", "bytes read", "bytes written")
+
+def empty_stage():
+	return dict((field, 0) for field in STAGE_FIELDS)
+
+def add_stage(total, stage):
+	for field in STAGE_FIELDS:
+		total[field] += stage[field]
+
+class instrument(object):
+	def __init__(self, report_path=None):
+		self.report_path = report_path
+		self.hooks = []
+		self.depth = 0
+		self.last_report = None
+		self.reset()
+
+	def reset(self):
+		self.stages = {}
+		self.workers = {}
+		self.notes = {}
+		self.started = time.time()
+
+	def add_hook(self, hook):
+		self.hooks.append(hook)
+
+	def __call_hooks(self, event, data):
+		for hook in self.hooks:
+			hook(event, data)
+
+	def record(self, name, seconds, frames=0, bytes_read=0, bytes_written=0):
+		record = {"calls":1, "seconds":seconds, "frames":frames, "bytes read":bytes_read, "bytes written":bytes_written}
+		add_stage(self.stages.setdefault(name, empty_stage()), record)
+		self.__call_hooks("stage", (name, record))
+
+	def note(self, name, value):
+		self.notes[name] = value
+		self.__call_hooks("note", (name, value))
+
+	@contextmanager
+	def stage(self, name, frames=0, bytes_read=0, bytes_written=0):
+		# The yielded counts can be filled in by the caller once they're known
+		counts = {"frames":frames, "bytes read":bytes_read, "bytes written":bytes_written}
+		start = time.time()
+		yield counts
+		self.record(name, time.time() - start, counts["frames"], counts["bytes read"], counts["bytes written"])
+
+	def collect(self):
+		# Called in a worker after each task; the parent merges the result
+		collected = {"pid":os.getpid(), "stages":self.stages}
+		self.stages = {}
+		return collected
+
+	def merge(self, collected, tasks=1):
+		worker = self.workers.setdefault(collected["pid"], {"tasks":0, "seconds":0, "bytes read":0, "bytes written":0})
+		worker["tasks"] += tasks
+		for name in collected["stages"]:
+			stage = collected["stages"][name]
+			add_stage(self.stages.setdefault(name, empty_stage()), stage)
+			for field in ("seconds", "bytes read", "bytes written"):
+				worker[field] += stage[field]
+
+	def report(self, run=None):
+		stages = {}
+		for name in self.stages:
+			stage = dict(self.stages[name])
+			seconds = stage["seconds"]
+			stage["frames per second"] = stage["frames"]/seconds if seconds > 0 else None
+			stage["MB per second"] = (stage["bytes read"] + stage["bytes written"])/2.0**20/seconds if seconds > 0 else None
+			stages[name] = stage
+		workers = dict((str(pid), dict(self.workers[pid])) for pid in self.workers)
+		return {"run":run, "pid":os.getpid(), "started":self.started, "seconds":time.time() - self.started, "stages":stages, "workers":workers, "notes":dict(self.notes)}
+
+	def emit(self, run=None):
+		report = self.report(run)
+		self.last_report = report
+		self.__call_hooks("report", report)
+		if self.report_path!=None:
+			with open(self.report_path, "a") as f:
+				f.write(json.dumps(report, sort_keys=True) + "\n")
+		self.reset()
+		return report
+
+	@contextmanager
+	def run(self, name):
+		# Runs can nest (gen_calib calls gen_bias); only the outermost one emits a report
+		if self.depth==0:
+			self.started = time.time()
+		self.depth += 1
+		try:
+			yield
+		finally:
+			self.depth -= 1
+			if self.depth==0:
+				self.emit(name)
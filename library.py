@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Content-addressed store of combined calibration stacks.
+Each entry is keyed by a fingerprint of its input frames (path, size and
+mtime) and the combine parameters, so the same set of raw frames is only
+ever combined once. Entries are the raw stacks (running sums for mean
+combines), before bias subtraction or flat normalisation, so they stay
+valid whatever bias is used with them. A sidecar JSON file lists the
+frames of each entry, so an entry for a subset of a new frame set can be
+extended instead of starting over. Least recently used entries are
+evicted by age and by total size.
+"""
+import os
+import json
+import time
+import hashlib
+import tempfile
+import numpy as np
+from os import listdir, makedirs
+from os.path import join, exists, abspath, expanduser
+
+LIBRARY_PATH = join(expanduser("~"), ".astroReducer", "library")
+MAX_AGE = 30*24*3600
+MAX_BYTES = 20*2**30
+
+def frame_ids(paths):
+	ids = []
+	for path in sorted(abspath(p) for p in paths):
+		st = os.stat(path)
+		ids.append((path, st.st_size, st.st_mtime))
+	return ids
+
+class library(object):
+	def __init__(self, path=LIBRARY_PATH, max_age=MAX_AGE, max_bytes=MAX_BYTES):
+		self.path = path
+		self.max_age = max_age
+		self.max_bytes = max_bytes
+
+	def fingerprint(self, ids, params):
+		digest = hashlib.sha1()
+		for path, size, mtime in ids:
+			digest.update("{}\0{}\0{!r}\n".format(path, size, mtime))
+		digest.update(repr(params))
+		return digest.hexdigest()
+
+	def entry(self, key, ext=".npy"):
+		return join(self.path, "{}{}".format(key, ext))
+
+	def get(self, key):
+		if not exists(self.entry(key)):
+			return None
+		# Touching the entry marks it as recently used for eviction
+		os.utime(self.entry(key), None)
+		return np.load(self.entry(key), mmap_mode="c")
+
+	def put(self, key, data, ids, params):
+		try:
+			if not exists(self.path):
+				makedirs(self.path)
+			with open(self.entry(key, ".json"), "w") as f:
+				json.dump({"frames":ids, "params":repr(params)}, f)
+			# Written under a temporary name first so a crash never leaves a truncated entry behind
+			handle, temp = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+			with os.fdopen(handle, "wb") as f:
+				np.save(f, data)
+			os.rename(temp, self.entry(key))
+		except (IOError, OSError, UnicodeError):
+			return False
+		self.evict()
+		return True
+
+	def find_subset(self, ids, params):
+		# The largest stored frame set that is contained in ids, with the same combine parameters
+		if not exists(self.path):
+			return None, []
+		wanted = set(ids)
+		best, best_ids = None, []
+		for f in listdir(self.path):
+			if not f.endswith(".json") or not exists(join(self.path, f[:-5] + ".npy")):
+				continue
+			try:
+				with open(join(self.path, f)) as handle:
+					info = json.load(handle)
+				# json gives the paths back as unicode, while frame_ids has the (utf-8) str from the filesystem
+				stored = [(path.encode("utf-8"), size, mtime) for path, size, mtime in info["frames"]]
+			except (IOError, ValueError, UnicodeError):
+				continue
+			if info["params"]==repr(params) and len(stored) > len(best_ids) and wanted.issuperset(stored):
+				best, best_ids = f[:-5], stored
+		return best, best_ids
+
+	def evict(self):
+		entries = []
+		for f in listdir(self.path):
+			if f.endswith(".npy"):
+				st = os.stat(join(self.path, f))
+				entries.append((st.st_mtime, st.st_size, join(self.path, f)))
+		entries.sort()
+		total = sum(size for used, size, path in entries)
+		now = time.time()
+		for used, size, path in entries:
+			if now - used <= self.max_age and total <= self.max_bytes:
+				break
+			for f in (path, path[:-4] + ".json"):
+				try:
+					os.remove(f)
+				except OSError:
+					pass
+			total -= size
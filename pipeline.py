@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Overlaps reading, computing and writing a run of frames.
+A reader thread loads up to `prefetch` frames ahead and a writer thread
+drains up to `write_behind` finished ones, so on slow disks or NFS the
+next read and the last write happen while the current frame is being
+computed. The bounded queues cap how many frames are in memory at once.
+File I/O and numpy release the GIL, so threads are enough for this.
+
+A bufferPool hands out arrays that are given back once written, so a
+worker reuses the same few frame-sized buffers instead of allocating
+new ones for every light.
+"""
+import sys
+import threading
+import numpy as np
+from Queue import Queue, Empty
+
+DONE = object()
+
+class stageFailure(object):
+	def __init__(self, exc_info):
+		self.exc_info = exc_info
+
+class bufferPool(object):
+	def __init__(self):
+		self.free = []
+		self.lock = threading.Lock()
+
+	def take(self, shape, dtype):
+		# Buffers are kept per frame shape and handed out as [:n] slices, so blocks of any length up
+		# to one already allocated share it; the smallest that fits is used
+		frames, frame_shape, dtype = shape[0], tuple(shape[1:]), np.dtype(dtype)
+		with self.lock:
+			fitting = [index for index, buffer in enumerate(self.free)
+				if buffer.shape[1:]==frame_shape and buffer.dtype==dtype and buffer.shape[0] >= frames]
+			if len(fitting)!=0:
+				index = min(fitting, key=lambda index: self.free[index].shape[0])
+				return self.free.pop(index)[:frames]
+		return np.empty(shape, dtype)
+
+	def give(self, array, keep):
+		# Only as many are kept as can be in flight at once, dropping the smallest first
+		while isinstance(array.base, np.ndarray):
+			array = array.base
+		with self.lock:
+			self.free.append(array)
+			while len(self.free) > keep:
+				self.free.pop(min(range(len(self.free)), key=lambda index: self.free[index].nbytes))
+
+	def clear(self):
+		with self.lock:
+			self.free = []
+
+def run_pipeline(items, read, compute, write, prefetch=2, write_behind=2):
+	# compute(item, loaded) returns (output, result). A None output has nothing to write and result is
+	# kept as is; otherwise write(item, output) gives the result. Results come back in completion order.
+	loaded = Queue(max(1, prefetch))
+	finished = Queue(max(1, write_behind))
+	results = []
+	failures = []
+	stop = threading.Event()
+
+	def reader():
+		try:
+			for item in items:
+				if stop.is_set():
+					return
+				loaded.put((item, read(item)))
+		except Exception:
+			loaded.put(stageFailure(sys.exc_info()))
+			return
+		loaded.put(DONE)
+
+	def writer():
+		while True:
+			job = finished.get()
+			if job is DONE:
+				return
+			# After a failure the queue is still drained so compute never blocks on it
+			if len(failures)!=0:
+				continue
+			try:
+				results.append(write(*job))
+			except Exception:
+				failures.append(sys.exc_info())
+
+	threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	try:
+		while len(failures)==0:
+			job = loaded.get()
+			if job is DONE:
+				break
+			if isinstance(job, stageFailure):
+				failures.append(job.exc_info)
+				break
+			output, result = compute(*job)
+			if output is None:
+				results.append(result)
+			else:
+				finished.put((job[0], output))
+	except Exception:
+		failures.append(sys.exc_info())
+	finally:
+		stop.set()
+		while threads[0].is_alive():
+			try:
+				loaded.get(timeout=0.1)
+			except Empty:
+				pass
+		finished.put(DONE)
+		for thread in threads:
+			thread.join()
+	if len(failures)!=0:
+		raise failures[0][0], failures[0][1], failures[0][2]
+	return results
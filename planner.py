@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+Precombined calibration for each (exposure, filter) pair of a light set.
+Bias and dark are summed into one offset and the flat is inverted once, so
+correcting a light is a single (data - offset) * inv_flat pass.
+"""
+import numpy as np
+
+def build_plan(cal_data, exp, fil, dtype=np.float64):
+	offset = None
+	if "data" in cal_data["BIAS"]:
+		offset = np.array(cal_data["BIAS"]["data"], dtype=dtype)
+	if exp in cal_data["DARK"] and "data" in cal_data["DARK"][exp]:
+		if offset is None:
+			offset = np.array(cal_data["DARK"][exp]["data"], dtype=dtype)
+		else:
+			offset += cal_data["DARK"][exp]["data"]
+	inv_flat = None
+	if fil in cal_data["Flat Field"] and "data" in cal_data["Flat Field"][fil]:
+		# Zero flat pixels become inf, which the output clipping deals with like a division would
+		with np.errstate(divide="ignore"):
+			inv_flat = np.reciprocal(np.array(cal_data["Flat Field"][fil]["data"], dtype=dtype))
+	return {"offset":offset, "inv flat":inv_flat}
+
+class planner(object):
+	def __init__(self):
+		self.plans = {}
+		self.version = 0
+
+	def invalidate(self):
+		# The version lets anything holding on to published plans tell that they're stale
+		self.plans = {}
+		self.version += 1
+
+	def plan(self, cal_data, exp, fil, dtype=np.float64):
+		key = (exp, fil, np.dtype(dtype).name)
+		if key not in self.plans:
+			self.plans[key] = build_plan(cal_data, exp, fil, dtype)
+		return self.plans[key]
+
+	def prepare(self, cal_data, keys):
+		# keys are (exposure, filter, dtype) as the lights will ask for them
+		for exp, fil, dtype in keys:
+			self.plan(cal_data, exp, fil, dtype)
+		return self.plans
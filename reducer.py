@@ -7,17 +7,37 @@ import sys
 import os
 from astropy.io import fits
 from os import listdir, makedirs
-from os.path import isfile, isdir, join, exists, splitext
+from os.path import isfile, isdir, join, exists, splitext, getsize
 import re
 from getpath import getpath
+from catalog import catalog, SCAN_THREADS
+from combine import combine_group, stack_result, COMBINE_BUDGET
 import uuid
-from multiprocessing import Pool, cpu_count
-import signal, time
-from pickler import *
+from multiprocessing import TimeoutError, cpu_count
+import signal, time, threading, atexit, weakref
+from sharedcal import publish, attach, release, footprint
+from scheduler import schedule_lights, block_frames, work_dtype, BLOCK_BUDGET
+from planner import planner
+from library import library, frame_ids
+from instrument import instrument
+from pipeline import run_pipeline, bufferPool
+from backends import BACKENDS, BACKEND_NAMES
+from fitshead import image_hdu, writeto
 
 import warnings
 warnings.filterwarnings("error")
 
+PRECISIONS = ("float32", "float64")
+# Integer output is unsigned and clipped to [0, 2**BITPIX-1]; astropy stores 16 and 32-bit values
+# with its own BZERO offset, replacing any BSCALE/BZERO the light was read with. Floats aren't clipped.
+OUTPUT_TYPES = {8:np.uint8, 16:np.uint16, 32:np.uint32, -32:np.float32, -64:np.float64}
+MASTER_TYPES = {"MASTER BIAS":"BIAS", "MASTER DARK":"DARK", "MASTER FLAT":"Flat Field"}
+WORKER_FIELDS = ("data", "master", "median")
+SAVED_PREFIXES = {"BIAS":"BIAS", "DARK":"DARK", "FLAT":"Flat Field"}
+# The dispatch window of 2 chunks per worker covers at most 1/FEED_ROUNDS of a run, so cancelling and
+# progress reports always have later chunks to act on
+FEED_ROUNDS = 4
+
 class reducer(object):
 	def __init__(self):
 		self.path = os.getcwd()
@@ -26,6 +46,35 @@ class reducer(object):
 		self.flat_path = self.path
 		self.light_path = self.path
 		self.cal_data = {"BIAS":{}, "DARK":{}, "Flat Field":{}}
+		self.catalogs = {}
+		self.planner = planner()
+		self.scan_threads = SCAN_THREADS
+		self.combine_mode = "mean"
+		self.combine_budget = COMBINE_BUDGET
+		self.combine_sigma = 3.0
+		self.combine_threads = 1
+		self.calib_workers = cpu_count()
+		# None lets the scheduler size these from the frames and free memory
+		self.light_workers = None
+		self.light_chunksize = None
+		self.memory_budget = None
+		self.block_budget = BLOCK_BUDGET
+		self.schedule = None
+		self.prefetch = 2
+		self.write_behind = 2
+		self.compress = False
+		self.quantize_level = None
+		self.backend = "shared"
+		self.pool = None
+		self.pool_size = None
+		self.pool_backend = None
+		self.pool_key = None
+		self.published = None
+		self.cancelled = False
+		self.buffers = bufferPool()
+		self.precision = "float32"
+		self.library = library()
+		self.instrument = instrument()
 
 	def __pathfinder(self, info):
 		path = raw_input(info).strip()
@@ -44,107 +93,208 @@ class reducer(object):
 		def __str__(self):
 			return "Error: {}".format(repr(self.errors))
 
+	def catalog(self, path):
+		if path not in self.catalogs:
+			self.catalogs[path] = catalog(path)
+		self.catalogs[path].threads = self.scan_threads
+		with self.instrument.stage("scan") as counts:
+			counts["frames"] = self.catalogs[path].refresh()
+		return self.catalogs[path]
+
 	def files(self, path, filetype, (obj, exp, fil) = (None, None, None)):
-		allfiles = [f for f in listdir(path) if isfile(join(path, f))]
-		for i,f in list(enumerate(allfiles)):
-			try:
-				header = fits.getheader(join(path, f))
-				if header["IMAGETYP"] != filetype:
-					allfiles[i] = None
-				if obj!=None and header["OBJECT"]!=obj:
-					allfiles[i] = None
-				if exp!=None and "EXPOSURE" in header and str(header["EXPOSURE"])!=exp:
-					allfiles[i] = None
-				elif exp!=None and "EXPTIME" in header and str(header["EXPTIME"])!=exp:
-					allfiles[i] = None 
-				if fil!=None and header["FILTER"]!=fil:
-					allfiles[i] = None
-			except (KeyError, IOError, Warning) as e:
-				allfiles[i] = None
-		return [f for f in allfiles if f != None]
-
-	def gen_bias(self):
-		onlyfiles = self.files(self.bias_path, "BIAS")
-		if len(onlyfiles)==0:
-			return ["Error: No bias files found."]
-		for f in onlyfiles:
-			data = fits.getdata(join(self.bias_path, f))
-			if "data" not in self.cal_data["BIAS"]:
-				self.cal_data["BIAS"]["data"] = data.astype(np.float64)
-				self.cal_data["BIAS"]["master"] = True
-			else:
-				self.cal_data["BIAS"]["data"] += data.astype(np.float64)
-		if "data" in self.cal_data["BIAS"]:
-			self.cal_data["BIAS"]["data"] /= len(onlyfiles)
-			#self.cal_data["BIAS"]["filename"] = self.__save_fits(self.bias_path, self.cal_data["BIAS"]["data"], "BIAS")
-		return []
-
-	def gen_darks(self):
-		onlyfiles = self.files(self.dark_path, "DARK")
-		if len(onlyfiles)==0:
-			return ["Error: No dark files found."]
-		for f in onlyfiles:
-			head = fits.getheader(join(self.dark_path, f))
-			data = fits.getdata(join(self.dark_path, f))
-			if "EXPOSURE" in head:
-				if head["EXPOSURE"] not in self.cal_data["DARK"]:
-					self.cal_data["DARK"][str(head["EXPOSURE"])] = {"data":data.astype(np.float64), "image count":1, "master":False}
-				else:
-					self.cal_data["DARK"][str(head["EXPOSURE"])]["data"] += data.astype(np.float64)
-					self.cal_data["DARK"][str(head["EXPOSURE"])]["image count"] += 1
-			elif "EXPTIME" in head and "EXPOSURE" not in head:
-				if head["EXPTIME"] not in self.cal_data["DARK"]:
-					self.cal_data["DARK"][str(head["EXPTIME"])] = {"data":data.astype(np.float64), "image count":1, "master":False}
-				else:
-					self.cal_data["DARK"][str(head["EXPTIME"])]["data"] += data.astype(np.float64)
-					self.cal_data["DARK"][str(head["EXPOSURE"])]["image count"] += 1
-			else:   
-				raise self.reduceError("No exposure time specified in fits header of {}".format(f))
-		for tag in self.cal_data["DARK"]:
-			self.cal_data["DARK"][tag]["data"] /= self.cal_data["DARK"][tag]["image count"]
-			if "data" in self.cal_data["BIAS"]:
-				self.cal_data["DARK"][tag]["data"] -= self.cal_data["BIAS"]["data"]
-				self.cal_data["DARK"][tag]["master"] = True
-			#self.cal_data["DARK"][tag]["filename"] = self.__save_fits(self.dark_path, self.cal_data["DARK"][tag]["data"], "DARK",{"EXPOSURE":float(tag)})
-		return []
-
-	def gen_flats(self):
-		onlyfiles = self.files(self.flat_path, "Flat Field")
-		if len(onlyfiles)==0:
-			return ["Error: No flat field files found."]
-		for f in onlyfiles:
-			head = fits.getheader(join(self.flat_path, f))
-			data = fits.getdata(join(self.flat_path, f))
-			if "FILTER" in head:
-				if head["FILTER"] not in self.cal_data["Flat Field"]:
-					self.cal_data["Flat Field"][str(head["FILTER"])] = {"data":data.astype(np.float64), "image count":1, "master":False}
-				else:
-					self.cal_data["Flat Field"][str(head["FILTER"])]["data"] += data.astype(np.float64)
-					self.cal_data["Flat Field"][str(head["FILTER"])]["image count"] += 1
-			else:   
-				raise self.reduceError("No filter specified in fits header of {}".format(f))
-		for tag in self.cal_data["Flat Field"]:
-			self.cal_data["Flat Field"][tag]["data"] /= self.cal_data["Flat Field"][tag]["image count"]
+		return self.catalog(path).query(filetype, obj, exp, fil)
+
+	def scan(self, path):
+		return self.catalog(path).inventory()
+
+	def dtype(self):
+		if self.precision not in PRECISIONS:
+			raise self.reduceError("Unknown precision: {}".format(self.precision))
+		return np.dtype(self.precision)
+
+	def __stack_params(self):
+		return (self.combine_mode, self.dtype().name, self.combine_sigma)
+
+	def __entry(self, kind, tag):
+		if kind=="BIAS":
+			return self.cal_data["BIAS"]
+		return self.cal_data[kind].get(tag, {})
+
+	def __previous_stack(self, kind, tag, ids, params):
+		# An earlier stack of some or all of these frames, from this session or the library.
+		# Only mean stacks (running sums) can be extended; robust combines have to match exactly.
+		entry = self.__entry(kind, tag)
+		if "stack" in entry and entry["params"]==params and set(ids).issuperset(entry["files"]):
+			if params[0]=="mean" or len(entry["files"])==len(ids):
+				return entry["stack"], entry["files"]
+		if self.library==None:
+			return None, []
+		stack = self.library.get(self.library.fingerprint(ids, params))
+		if stack is not None:
+			return stack, ids
+		if params[0]=="mean":
+			key, stored = self.library.find_subset(ids, params)
+			if key!=None:
+				stack = self.library.get(key)
+				if stack is not None:
+					return stack, stored
+		return None, []
+
+	def __group_jobs(self, inv, kind):
+		if kind=="DARK":
+			field, missing = "exposure", "exposure time"
+		else:
+			field, missing = "filter", "filter"
+		groups = inv.group(kind, field)
+		if None in groups:
+			raise self.reduceError("No {} specified in fits header of {}".format(missing, groups[None][0]["filename"]))
+		return [(kind, tag, [frame["path"] for frame in groups[tag]]) for tag in groups]
+
+	def __combine_groups(self, jobs, progress=None):
+		# Only frames that aren't already in an earlier stack get read. The remaining groups are
+		# independent, so each one is combined in its own process.
+		params = self.__stack_params()
+		pending = {}
+		tasks = []
+		done = 0
+		for kind, tag, paths in jobs:
+			ids = frame_ids(paths)
+			stack, stacked = self.__previous_stack(kind, tag, ids, params)
+			if len(stacked)==len(ids):
+				if self.__entry(kind, tag).get("stack") is not stack:
+					self.__store_master(kind, tag, ids, params, stack)
+				done += 1
+				if progress!=None:
+					progress(kind, tag, done, len(jobs))
+				continue
+			stacked = set(stacked)
+			pending[(kind, tag)] = (ids, stack)
+			tasks.append((kind, tag, [path for path, size, mtime in ids if (path, size, mtime) not in stacked],
+				self.combine_mode, self.dtype(), self.combine_budget, self.combine_sigma, self.combine_threads))
+		if self.calib_workers > 1 and len(tasks) > 1 and BACKENDS[self.backend].max_workers!=1:
+			p = BACKENDS[self.backend].pool(min(self.calib_workers, len(tasks)), None, ())
+			results = p.imap_unordered(combine_group, tasks)
+		else:
+			p = None
+			results = (combine_group(task) for task in tasks)
+		try:
+			for kind, tag, stack, stats in results:
+				self.instrument.merge(stats)
+				ids, previous = pending[(kind, tag)]
+				if previous is not None:
+					stack += previous
+				if self.library!=None:
+					with self.instrument.stage("library", bytes_written=stack.nbytes):
+						self.library.put(self.library.fingerprint(ids, params), stack, ids, params)
+				self.__store_master(kind, tag, ids, params, stack)
+				done += 1
+				if progress!=None:
+					progress(kind, tag, done, len(jobs))
+			if p!=None:
+				p.close()
+		finally:
+			if p!=None:
+				p.terminate()
+				p.join()
+
+	def __store_master(self, kind, tag, ids, params, stack):
+		self.planner.invalidate()
+		entry = {"stack":stack, "files":ids, "params":params, "image count":len(ids), "master":False}
+		if kind=="BIAS":
+			entry["data"] = stack_result(stack, len(ids), params[0])
+			entry["master"] = True
+			self.cal_data["BIAS"] = entry
+			# Anything subtracted with the old bias has to be redone from its stack
+			for other in ("DARK", "Flat Field"):
+				for key in self.cal_data[other]:
+					if "stack" in self.cal_data[other][key]:
+						self.__apply_bias(other, key)
+		else:
+			self.cal_data[kind][tag] = entry
+			self.__apply_bias(kind, tag)
+
+	def __apply_bias(self, kind, tag):
+		with self.instrument.stage("normalise", frames=1):
+			entry = self.cal_data[kind][tag]
+			entry["data"] = stack_result(entry["stack"], entry["image count"], entry["params"][0])
+			entry["master"] = False
 			if "data" in self.cal_data["BIAS"]:
-				self.cal_data["Flat Field"][tag]["data"] -= self.cal_data["BIAS"]["data"]
-				self.cal_data["Flat Field"][tag]["master"] = True
-			self.cal_data["Flat Field"][tag]["median"] = np.median(self.cal_data["Flat Field"][tag]["data"])
-			self.cal_data["Flat Field"][tag]["data"] /= self.cal_data["Flat Field"][tag]["median"]
-			#self.cal_data["Flat Field"][tag]["filename"] = self.__save_fits(self.flat_path, self.cal_data["Flat Field"][tag]["data"], "FLAT",{"FILTER":tag})
-		return []
+				entry["data"] -= self.cal_data["BIAS"]["data"]
+				entry["master"] = True
+			if kind=="Flat Field":
+				entry["median"] = np.median(entry["data"])
+				entry["data"] /= entry["median"]
+
+	def gen_bias(self, inv=None, progress=None):
+		with self.instrument.run("gen_bias"):
+			if inv==None:
+				inv = self.scan(self.bias_path)
+			frames = inv.select("BIAS")
+			if len(frames)==0:
+				return ["Error: No bias files found."]
+			self.__combine_groups([("BIAS", None, [frame["path"] for frame in frames])], progress)
+			return []
+
+	def gen_darks(self, inv=None, progress=None):
+		with self.instrument.run("gen_darks"):
+			if inv==None:
+				inv = self.scan(self.dark_path)
+			jobs = self.__group_jobs(inv, "DARK")
+			if len(jobs)==0:
+				return ["Error: No dark files found."]
+			self.__combine_groups(jobs, progress)
+			return []
+
+	def gen_flats(self, inv=None, progress=None):
+		with self.instrument.run("gen_flats"):
+			if inv==None:
+				inv = self.scan(self.flat_path)
+			jobs = self.__group_jobs(inv, "Flat Field")
+			if len(jobs)==0:
+				return ["Error: No flat field files found."]
+			self.__combine_groups(jobs, progress)
+			return []
+
+	def gen_calib(self, progress=None):
+		with self.instrument.run("gen_calib"):
+			# One scan per distinct directory; with everything in one folder that is a single pass
+			inventories = {}
+			for path in (self.bias_path, self.dark_path, self.flat_path):
+				if path not in inventories:
+					inventories[path] = self.scan(path)
+			# Darks and flats are bias subtracted as they come back, so the bias has to be finished first
+			errors = self.gen_bias(inventories[self.bias_path], progress)
+			dark_jobs = self.__group_jobs(inventories[self.dark_path], "DARK")
+			if len(dark_jobs)==0:
+				errors.append("Error: No dark files found.")
+			flat_jobs = self.__group_jobs(inventories[self.flat_path], "Flat Field")
+			if len(flat_jobs)==0:
+				errors.append("Error: No flat field files found.")
+			self.__combine_groups(dark_jobs + flat_jobs, progress)
+			return errors
 
 	def update_cal(self):
-		if "data" in self.cal_data["BIAS"]:
-			for tag in self.cal_data["DARK"]:
-				if not self.cal_data["DARK"][tag]["master"]:
-					self.cal_data["DARK"][tag]["data"] -= self.cal_data["BIAS"]["data"]
-					self.cal_data["DARK"][tag]["master"] = True
-			for tag in self.cal_data["Flat Field"]:
-				if not self.cal_data["Flat Field"][tag]["master"]:
-					self.cal_data["Flat Field"][tag]["data"] *= self.cal_data["Flat Field"][tag]["median"]
-					self.cal_data["Flat Field"][tag]["data"] -= self.cal_data["BIAS"]["data"]
-					self.cal_data["Flat Field"][tag]["data"] /= self.cal_data["Flat Field"][tag]["median"]
-					self.cal_data["Flat Field"][tag]["master"] = True
+		# Masters with a stack are rebuilt from it; ones loaded from disk are corrected in place
+		with self.instrument.stage("update_cal"):
+			if "data" in self.cal_data["BIAS"]:
+				for tag in self.cal_data["DARK"]:
+					if not self.cal_data["DARK"][tag]["master"]:
+						if "stack" in self.cal_data["DARK"][tag]:
+							self.__apply_bias("DARK", tag)
+						else:
+							self.cal_data["DARK"][tag]["data"] -= self.cal_data["BIAS"]["data"]
+							self.cal_data["DARK"][tag]["master"] = True
+						self.planner.invalidate()
+				for tag in self.cal_data["Flat Field"]:
+					if not self.cal_data["Flat Field"][tag]["master"]:
+						if "stack" in self.cal_data["Flat Field"][tag]:
+							self.__apply_bias("Flat Field", tag)
+						else:
+							self.cal_data["Flat Field"][tag]["data"] *= self.cal_data["Flat Field"][tag]["median"]
+							self.cal_data["Flat Field"][tag]["data"] -= self.cal_data["BIAS"]["data"]
+							self.cal_data["Flat Field"][tag]["data"] /= self.cal_data["Flat Field"][tag]["median"]
+							self.cal_data["Flat Field"][tag]["master"] = True
+						self.planner.invalidate()
 
 
 	def count_calib(self):
@@ -161,12 +311,56 @@ class reducer(object):
 	def save_calib(self):
 		self.update_cal()
 		if "data" in self.cal_data["BIAS"]:
-			filename = self.__save_fits(self.bias_path, self.cal_data["BIAS"]["data"], "BIAS")
+			filename = self.__save_fits(self.bias_path, self.cal_data["BIAS"]["data"], "BIAS", cards={"IMAGETYP":"MASTER BIAS"})
 		for tag in self.cal_data["DARK"]:
-			filename = self.__save_fits(self.dark_path, self.cal_data["DARK"][tag]["data"], "DARK",{"EXPOSURE":float(tag)})
+			cards = {"IMAGETYP":"MASTER DARK", "NCOMBINE":self.cal_data["DARK"][tag]["image count"], "BIASSUB":self.cal_data["DARK"][tag]["master"]}
+			filename = self.__save_fits(self.dark_path, self.cal_data["DARK"][tag]["data"], "DARK",{"EXPOSURE":self.__exposure_value(tag)}, cards=cards)
 		for tag in self.cal_data["Flat Field"]:
-			filename = self.__save_fits(self.flat_path, self.cal_data["Flat Field"][tag]["data"], "FLAT",{"FILTER":tag})
-	
+			cards = {"IMAGETYP":"MASTER FLAT", "NCOMBINE":self.cal_data["Flat Field"][tag]["image count"], "BIASSUB":self.cal_data["Flat Field"][tag]["master"], "FLATMED":float(self.cal_data["Flat Field"][tag]["median"])}
+			filename = self.__save_fits(self.flat_path, self.cal_data["Flat Field"][tag]["data"], "FLAT",{"FILTER":tag}, cards=cards)
+
+	def __exposure_value(self, tag):
+		# Keep integer exposures integer so the tag reads back the same way from the saved header
+		try:
+			return int(tag)
+		except ValueError:
+			return float(tag)
+
+	def load_calib(self, path):
+		# Finds masters written by save_calib; older saves without IMAGETYP are recognised by filename.
+		# save_calib never replaces a file, so where several sets were saved only the newest of each is loaded.
+		newest = {}
+		for frame in self.scan(path).frames:
+			if frame["imagetyp"] in MASTER_TYPES:
+				kind = MASTER_TYPES[frame["imagetyp"]]
+			elif frame["imagetyp"]==None and frame["filename"].split("-")[0] in SAVED_PREFIXES:
+				kind = SAVED_PREFIXES[frame["filename"].split("-")[0]]
+			else:
+				continue
+			if kind=="DARK" and frame["exposure"]==None or kind=="Flat Field" and frame["filter"]==None:
+				continue
+			key = (kind, {"BIAS":None, "DARK":frame["exposure"], "Flat Field":frame["filter"]}[kind])
+			if key not in newest or (frame["mtime"], frame["filename"]) > (newest[key]["mtime"], newest[key]["filename"]):
+				newest[key] = frame
+		loaded = []
+		for (kind, tag), frame in sorted(newest.items()):
+			image = fits.open(frame["path"], memmap=True, mode="copyonwrite")
+			data = image_hdu(image).data
+			if data.dtype.newbyteorder("=")!=self.dtype():
+				data = data.astype(self.dtype())
+			header = image_hdu(image).header
+			if kind=="BIAS":
+				self.cal_data["BIAS"] = {"data":data, "master":True}
+			elif kind=="DARK":
+				self.cal_data["DARK"][frame["exposure"]] = {"data":data, "image count":header.get("NCOMBINE", 1), "master":header.get("BIASSUB", True)}
+			else:
+				self.cal_data["Flat Field"][frame["filter"]] = {"data":data, "image count":header.get("NCOMBINE", 1), "master":header.get("BIASSUB", True), "median":header.get("FLATMED", 1.0)}
+			image.close()
+			loaded.append(frame["filename"])
+		if len(loaded)!=0:
+			self.planner.invalidate()
+		return loaded
+
 	def check_calib(self, frame_type="ALL"):
 		warnings = []
 		if frame_type=="BIAS":
@@ -195,89 +389,416 @@ class reducer(object):
 		return warnings
 
 	def sigint_handler(self, signum, frame):
-		pass
+		self.cancelled = True
 
-	def red_light(self, match=(None,None,None)):
-		if not exists(join(self.light_path,"Corrected")):
-			makedirs(join(self.light_path,"Corrected"))
-		self.update_cal()
-		onlyfiles = self.files(self.light_path, "LIGHT", match)
-		use_cpus = (cpu_count()/2) + 1
-		p = Pool(use_cpus)
-		signal.signal(signal.SIGINT, self.sigint_handler)
-		files = p.map(self.red_light_pool, onlyfiles)
-		signal.signal(signal.SIGINT, signal.SIG_DFL)
-		return files
-	
-	def red_light_pool(self, filename):
-		image = fits.open(join(self.light_path,filename))
-		data = image[0].data.astype(np.float64)
-		if "data" in self.cal_data["BIAS"]:
-			data -= self.cal_data["BIAS"]["data"]
-		try:
-			if "EXPOSURE" in image[0].header:
-				if "data" in self.cal_data["DARK"][str(image[0].header["EXPOSURE"])]:
-					data -= self.cal_data["DARK"][str(image[0].header["EXPOSURE"])]["data"]
-			elif "EXPTIME" in image[0].header:
-				if "data" in self.cal_data["DARK"][str(image[0].header["EXPTIME"])]:
-					data -= self.cal_data["DARK"][str(image[0].header["EXPTIME"])]["data"]
+	def __feed(self, blocks, window):
+		# Chunks go to the pool only as earlier ones come back, so a cancel leaves little queued.
+		# Chunks are pipelined in the workers, but shrink for small runs so every worker gets some.
+		chunksize = max(1, min(self.schedule["chunksize"], len(blocks)/(FEED_ROUNDS*2*self.pool_size)))
+		for start in range(0, len(blocks), chunksize):
+			window.acquire()
+			if self.cancelled:
+				return
+			yield blocks[start:start+chunksize]
+
+	def light_blocks(self, lights):
+		# Lights sharing exposure, filter, shape and BITPIX are corrected together as one 3-D block.
+		# Blocks are kept small enough that a group still spans FEED_ROUNDS dispatch windows.
+		groups = {}
+		blocks = []
+		for frame in lights:
+			key = (frame["exposure"], frame["filter"], frame["naxis1"], frame["naxis2"], frame["bitpix"])
+			if None in key or not self.block_budget:
+				blocks.append([frame["filename"]])
+			else:
+				groups.setdefault(key, []).append(frame["filename"])
+		for key in sorted(groups):
+			filenames = groups[key]
+			size = block_frames((key[4], key[2]*key[3]), self.dtype(), self.block_budget)
+			size = max(1, min(size, -(-len(filenames) // (FEED_ROUNDS*2*self.pool_size))))
+			blocks.extend(filenames[start:start+size] for start in range(0, len(filenames), size))
+		return blocks
+
+	def light_pool(self, pairs=(), frames=()):
+		# One pool serves every red_light call. Masters are only republished when they've changed or new
+		# (exposure, filter) plans are needed, and workers pick up a new set with their next task.
+		# Process workers without shared memory are given their copy when the pool starts, so for them
+		# the pool is restarted instead, as it is for a new backend or worker count.
+		if self.backend not in BACKENDS:
+			raise self.reduceError("Unknown backend \"{}\", expected one of {}".format(self.backend, ", ".join(BACKEND_NAMES)))
+		backend = BACKENDS[self.backend]
+		dtype = self.dtype().name
+		# Each pair is planned in every dtype its lights are corrected in
+		dtypes = set(work_dtype(frame["bitpix"], self.dtype()).name for frame in frames) or set([dtype])
+		plans = set((exp, fil, name) for exp, fil in pairs for name in dtypes)
+		published = self.published
+		if (published==None or published["shared"]!=backend.shared or published["version"]!=self.planner.version
+				or published["dtype"]!=dtype or not plans.issubset(published["plans"])):
+			if published!=None and published["version"]==self.planner.version and published["dtype"]==dtype:
+				plans |= published["plans"]
+			masters = {"cal_data":self.worker_cal_data(), "plans":self.planner.prepare(self.cal_data, plans)}
+			if backend.shared:
+				masters = publish(masters)
+			self.published = {"masters":masters, "shared":backend.shared, "version":self.planner.version, "dtype":dtype, "plans":plans,
+				"count":published["count"] + 1 if published!=None else 1}
+			# Idle workers may still have the old files mapped, which is fine once they're unlinked
+			if published!=None and published["shared"]:
+				release(published["masters"])
+		settings = self.worker_settings()
+		state = {"key":(self.published["count"], repr(sorted(settings.items()))), "shared":backend.shared, "masters":self.published["masters"],
+			"settings":settings, "light_path":self.light_path}
+		if backend.shared:
+			shared, copied = footprint(self.published["masters"]["tree"]), 0
+		elif backend.processes:
+			shared, copied = 0, footprint(self.published["masters"])
+		else:
+			shared, copied = footprint(self.published["masters"]), 0
+		# Free memory is read with the masters already published and the current pool already running, so
+		# both are added back; otherwise each call would see less and resize the pool for nothing
+		reclaimable = shared
+		if self.pool!=None and self.schedule!=None and self.schedule["per worker"]!=None:
+			reclaimable += self.pool_size*self.schedule["per worker"]
+		self.schedule = schedule_lights(frames, shared, self.dtype(), self.prefetch, self.write_behind, self.light_workers, self.light_chunksize,
+			self.memory_budget, self.block_budget, copied, backend.max_workers, reclaimable)
+		self.schedule["backend"] = backend.name
+		self.instrument.note("schedule", self.schedule)
+		copies = backend.processes and not backend.shared
+		if (self.pool==None or self.pool_size!=self.schedule["workers"] or self.pool_backend!=backend.name
+				or copies and self.pool_key!=state["key"]):
+			self.close_pool()
+			self.pool = backend.pool(self.schedule["workers"], attach_light_worker, (state,))
+			self.pool_size = self.schedule["workers"]
+			self.pool_backend = backend.name
+			self.pool_key = state["key"]
+			open_reducers.add(self)
+		if copies:
+			# The workers already have this set, so tasks don't need to carry it
+			state = dict(state, masters=None)
+		return self.pool, state
+
+	def worker_cal_data(self):
+		# Workers only need the finished masters, not the stacks and file lists behind them
+		def fields(entry):
+			return dict((key, entry[key]) for key in WORKER_FIELDS if key in entry)
+		return {"BIAS":fields(self.cal_data["BIAS"]),
+			"DARK":dict((tag, fields(self.cal_data["DARK"][tag])) for tag in self.cal_data["DARK"]),
+			"Flat Field":dict((tag, fields(self.cal_data["Flat Field"][tag])) for tag in self.cal_data["Flat Field"])}
+
+	def close_pool(self):
+		if self.pool!=None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+
+	def close(self):
+		self.close_pool()
+		open_reducers.discard(self)
+		if self.published!=None:
+			if self.published["shared"]:
+				release(self.published["masters"])
+			self.published = None
+
+	def worker_settings(self):
+		return {"precision":self.precision, "prefetch":self.prefetch, "write_behind":self.write_behind, "compress":self.compress, "quantize_level":self.quantize_level}
+
+	def red_light(self, match=(None,None,None), progress=None):
+		with self.instrument.run("red_light"):
+			if not exists(join(self.light_path,"Corrected")):
+				makedirs(join(self.light_path,"Corrected"))
+			self.update_cal()
+			lights = self.scan(self.light_path).select("LIGHT", match)
+			onlyfiles = [frame["filename"] for frame in lights]
+			pairs = set((frame["exposure"], frame["filter"]) for frame in lights if frame["exposure"]!=None and frame["filter"]!=None)
+			# Plans and masters go to the workers as memory-mapped files; tasks are just filenames
+			with self.instrument.stage("publish"):
+				p, state = self.light_pool(pairs, lights)
+			blocks = self.light_blocks(lights)
+			self.cancelled = False
+			files = []
+			window = threading.Semaphore(2*self.pool_size)
+			# Whatever handled Ctrl-C before (batch, the menus) gets it back afterwards
+			previous = signal.signal(signal.SIGINT, self.sigint_handler)
+			try:
+				with self.instrument.stage("lights") as counts:
+					results = p.imap_unordered(reduce_light_chunk, ((state, chunk) for chunk in self.__feed(blocks, window)))
+					while True:
+						# A timed wait, so Ctrl-C is handled while the workers are busy
+						try:
+							chunk = results.next(0.5)
+						except TimeoutError:
+							continue
+						except StopIteration:
+							break
+						window.release()
+						chunk_results, stats = chunk
+						self.instrument.merge(stats, len(chunk_results))
+						for result in chunk_results:
+							files.append(result)
+							if progress!=None:
+								progress(result, len(files), len(onlyfiles))
+					counts["frames"] = len(files)
+			except:
+				# Stop the feeder and drop the pool, which may still be busy with what it was handed
+				self.cancelled = True
+				window.release()
+				self.close_pool()
+				raise
+			finally:
+				signal.signal(signal.SIGINT, previous if previous!=None else signal.SIG_DFL)
+			return files
+
+	def plan(self, exp, fil, bitpix=None):
+		return self.planner.plan(self.cal_data, exp, fil, work_dtype(bitpix, self.dtype()))
+
+	def light_calibration(self, header, filename):
+		if "EXPOSURE" in header:
+			exp = str(header["EXPOSURE"])
+		elif "EXPTIME" in header:
+			exp = str(header["EXPTIME"])
+		else:
+			raise self.reduceError("{} not reduced - no exposure specified in header".format(filename))
+		if "FILTER" not in header:
+			raise self.reduceError("{} not reduced - no filter specified in header".format(filename))
+		return exp, str(header["FILTER"])
+
+	def correct_light(self, hdu, filename):
+		exp, fil = self.light_calibration(hdu.header, filename)
+		return self.correct_block([hdu.data], exp, fil, hdu.header["BITPIX"])[0]
+
+	def correct_block(self, frames, exp, fil, bitpix):
+		# The frames are stacked into one 3-D array so the masters broadcast over all of them in one pass.
+		# Working and output arrays come from self.buffers, and the result can go back once it's written.
+		if bitpix not in OUTPUT_TYPES:
+			raise self.reduceError("Unknown BITPIX: {}".format(bitpix))
+		shape = (len(frames),) + frames[0].shape
+		with self.instrument.stage("correct", frames=len(frames)):
+			# float32 can't hold every 32-bit integer or double value, so those lights (and their plans) stay in float64
+			plan = self.plan(exp, fil, bitpix)
+			data = self.buffers.take(shape, work_dtype(bitpix, self.dtype()))
+			for index, frame in enumerate(frames):
+				data[index] = frame
+			if plan["offset"] is not None:
+				data -= plan["offset"]
+			if plan["inv flat"] is not None:
+				data *= plan["inv flat"]
+		with self.instrument.stage("convert", frames=len(frames)):
+			if data.dtype==OUTPUT_TYPES[bitpix]:
+				# Float lights corrected at their own precision are already in their output type
+				return data
+			output = self.__convert_array(data, bitpix, self.buffers.take(shape, OUTPUT_TYPES[bitpix]))
+			self.__release(data)
+			return output
+
+	def __release(self, array):
+		# Enough are kept for every block the pipeline can be holding at once, whatever their lengths
+		self.buffers.give(array, self.write_behind + 2)
+
+	def __read_light(self, filename):
+		# Read into memory rather than memory-mapped, so the I/O happens here and not during the correction
+		with self.instrument.stage("read", frames=1, bytes_read=getsize(join(self.light_path,filename))):
+			image = fits.open(join(self.light_path,filename), memmap=False)
+			image_hdu(image).data
+		return image
+
+	def __write_light(self, filename, image):
+		with self.instrument.stage("write", frames=1) as counts:
+			if self.compress:
+				hdu = image_hdu(image)
+				writeto(self.__compressed(hdu.data, hdu.header), join(join(self.light_path,"Corrected"), filename))
 			else:
+				writeto(image, join(join(self.light_path,"Corrected"), filename))
+			image.close()
+			counts["bytes written"] = getsize(join(join(self.light_path,"Corrected"), filename))
+		return join(join(self.light_path,"Corrected"), filename)
+
+	def red_light_pool(self, filename):
+		return self.red_light_block([filename])[0]
+
+	def __read_block(self, filenames):
+		return [self.__read_light(filename) for filename in filenames]
+
+	def __correct_images(self, filenames, images):
+		# Frames are checked against each other rather than trusting the catalog, which may be stale
+		messages = []
+		groups = {}
+		for filename, image in zip(filenames, images):
+			hdu = image_hdu(image)
+			try:
+				key = self.light_calibration(hdu.header, filename) + (hdu.data.shape, hdu.header["BITPIX"])
+				if key[3] not in OUTPUT_TYPES:
+					raise self.reduceError("{} not reduced - unknown BITPIX {}".format(filename, key[3]))
+			except self.reduceError as e:
 				image.close()
-				return "{} not reduced - no exposure specified in header".format(filename)
-				#raise self.reduceError("No exposure time specified in {}".format(filename))
-		except KeyError:
-			pass
-			#raise self.reduceError("No matching dark frames for {}".format(filename))
-		try:
-			if "FILTER" in image[0].header:
-				if "data" in self.cal_data["Flat Field"][str(image[0].header["FILTER"])]:
-					data /= self.cal_data["Flat Field"][str(image[0].header["FILTER"])]["data"]
-			else:   
+				messages.append(e.errors)
+				continue
+			groups.setdefault(key, []).append((filename, image))
+		ready = []
+		buffers = []
+		for (exp, fil, shape, bitpix), group in groups.items():
+			data = self.correct_block([image_hdu(image).data for filename, image in group], exp, fil, bitpix)
+			buffers.append(data)
+			for index, (filename, image) in enumerate(group):
+				image_hdu(image).data = data[index]
+				ready.append((filename, image))
+		if len(ready)==0:
+			return None, messages
+		return (ready, messages, buffers), None
+
+	def __write_images(self, filenames, (images, messages, buffers)):
+		for filename, image in images:
+			messages.append(self.__write_light(filename, image))
+		for data in buffers:
+			self.__release(data)
+		return messages
+
+	def red_light_block(self, filenames):
+		images = self.__read_block(filenames)
+		output, messages = self.__correct_images(filenames, images)
+		if output is None:
+			return messages
+		return self.__write_images(filenames, output)
+
+	def red_light_blocks(self, blocks):
+		# Reading the next block and writing the last one overlap with correcting this one
+		if len(blocks)==1 or self.prefetch < 1:
+			results = [self.red_light_block(filenames) for filenames in blocks]
+		else:
+			results = run_pipeline(blocks, self.__read_block, self.__correct_images, self.__write_images, self.prefetch, self.write_behind)
+		return [result for block in results for result in block]
+
+	def check_precision(self, match=(None,None,None), sample=5):
+		# Rebuilds the masters in float64 from the same raw frames and compares corrected output.
+		# Masters loaded with load_calib have no raw frames here, so the reference gets float64 copies of them.
+		self.update_cal()
+		reference = reducer()
+		reference.bias_path, reference.dark_path, reference.flat_path = self.bias_path, self.dark_path, self.flat_path
+		reference.light_path = self.light_path
+		reference.combine_mode, reference.combine_budget, reference.combine_sigma = self.combine_mode, self.combine_budget, self.combine_sigma
+		reference.calib_workers = self.calib_workers
+		reference.backend = self.backend
+		# Same library as this reducer, so a float64 check never writes stacks where this one wouldn't
+		reference.library = self.library
+		reference.precision = "float64"
+		for kind, generate in (("BIAS", reference.gen_bias), ("DARK", reference.gen_darks), ("Flat Field", reference.gen_flats)):
+			entries = [self.cal_data["BIAS"]] if kind=="BIAS" else self.cal_data[kind].values()
+			if any("stack" in entry for entry in entries):
+				generate()
+		def loaded(entry):
+			copy = dict((field, entry[field]) for field in WORKER_FIELDS if field in entry)
+			copy["data"] = np.array(entry["data"], dtype=np.float64)
+			return copy
+		if "data" in self.cal_data["BIAS"] and "stack" not in self.cal_data["BIAS"]:
+			reference.cal_data["BIAS"] = loaded(self.cal_data["BIAS"])
+		for kind in ("DARK", "Flat Field"):
+			for tag, entry in self.cal_data[kind].items():
+				if "data" in entry and "stack" not in entry:
+					reference.cal_data[kind][tag] = loaded(entry)
+		reference.planner.invalidate()
+		reference.update_cal()
+		report = {"frames":0, "pixels":0, "pixels differing":0, "max difference":0.0}
+		for filename in self.scan(self.light_path).files("LIGHT", match)[:sample]:
+			image = fits.open(join(self.light_path,filename))
+			try:
+				test = self.correct_light(image_hdu(image), filename).astype(np.float64)
+				expected = reference.correct_light(image_hdu(image), filename).astype(np.float64)
+			except self.reduceError:
+				continue
+			finally:
 				image.close()
-				return "{} not reduced - no filter specified in header".format(filename)
-				#raise self.reduceError("No filter specified in {}".format(filename))
-		except KeyError:
-			pass
-			#raise self.reduceError("No matching flat frames for {}".format(filename))
-		data = np.clip(data, 0, 2**(image[0].header["BITPIX"])-1)
-		data = self.__convert_array(data, image[0].header["BITPIX"])
-		image[0].data = data
-		image.writeto(join(join(self.light_path,"Corrected"), filename), clobber=True)
-		image.close()
-		return join(join(self.light_path,"Corrected"), filename)
+			diff = np.abs(test - expected)
+			report["frames"] += 1
+			report["pixels"] += diff.size
+			report["pixels differing"] += int(np.count_nonzero(diff))
+			report["max difference"] = max(report["max difference"], float(diff.max()))
+		return report
 
-	def __convert_array(self, data, bitpix):
-		if bitpix > 0:
-			data = np.clip(data, 0, 2**(bitpix)-1)
-		if bitpix == 8:
-			data = data.astype(np.uint8)
-		elif bitpix == 16:
-			data = data.astype(np.uint16)
-		elif bitpix == 32:
-			data = data.astype(np.uint32)
-		elif bitpix == -32:
-			data = data.astype(np.float32)
-		elif bitpix == -64:
-			data = data.astype(np.float64)
-		else:   
+	def __convert_array(self, data, bitpix, out=None):
+		# Casting into out clips data in place first, so it's only done with scratch arrays
+		if bitpix not in OUTPUT_TYPES:
 			raise self.reduceError("Unknown BITPIX: {}".format(bitpix))
-		return data
+		if bitpix > 0:
+			data = np.clip(data, 0, 2**bitpix-1, out=None if out is None else data)
+		if out is None:
+			return data.astype(OUTPUT_TYPES[bitpix])
+		np.copyto(out, data, casting="unsafe")
+		return out
+
+	def __compressed(self, data, header=None):
+		# Integers are RICE compressed losslessly. Floats are GZIP'd losslessly, or RICE compressed
+		# after quantizing if a quantize level is set.
+		if data.dtype.kind in "ui":
+			hdu = fits.CompImageHDU(data, header, compression_type="RICE_1")
+		elif self.quantize_level==None:
+			hdu = fits.CompImageHDU(data, header, compression_type="GZIP_2", quantize_level=0)
+		else:
+			hdu = fits.CompImageHDU(data, header, compression_type="RICE_1", quantize_level=self.quantize_level)
+		return fits.HDUList([fits.PrimaryHDU(), hdu])
 
-	def __save_fits(self, path, data, filetype, tags = {}, bitpix=-32):
+	def __save_fits(self, path, data, filetype, tags = {}, bitpix=-32, cards = {}):
 		data = self.__convert_array(data, bitpix)
-		hdu = fits.PrimaryHDU(data)
-		newfits = fits.HDUList([hdu])
+		if self.compress:
+			newfits = self.__compressed(data)
+		else:
+			newfits = fits.HDUList([fits.PrimaryHDU(data)])
+		hdu = image_hdu(newfits)
 		ext = "-"
 		for tag in tags:
 			ext += str(tags[tag]) + "-"
-			newfits[0].header[tag] = tags[tag]
+			hdu.header[tag] = tags[tag]
+		for card in cards:
+			hdu.header[card] = cards[card]
 		filename = join(path, "{}{}{}".format(filetype, ext, self.__gen_temp_fits()))
-		newfits[0].header["BITPIX"]=bitpix
+		if not self.compress:
+			hdu.header["BITPIX"]=bitpix
 		#if not exists(path):
 		#	makedirs(path)
-		newfits.writeto(filename, clobber = True)
+		with self.instrument.stage("save", frames=1) as counts:
+			writeto(newfits, filename)
+			counts["bytes written"] = getsize(filename)
 		return filename
 
 	def __gen_temp_fits(self):
 		return "{}.fits".format(uuid.uuid4())
 
+# Reducers with a pool are only weakly held here, so one that's closed and dropped can still be freed
+open_reducers = weakref.WeakSet()
+
+def close_open_reducers():
+	for datareducer in list(open_reducers):
+		datareducer.close()
+
+atexit.register(close_open_reducers)
+
+# Every worker thread or process has its own reducer, so thread pools don't share buffers or timings
+light_local = threading.local()
+
+def attach_light_worker(state):
+	if state["shared"]:
+		masters = attach(state["masters"])
+	else:
+		masters = state["masters"]
+	worker = reducer()
+	for key in state["settings"]:
+		setattr(worker, key, state["settings"][key])
+	worker.cal_data = masters["cal_data"]
+	worker.planner.plans = masters["plans"]
+	light_local.worker = worker
+	light_local.key = state["key"]
+
+def current_light_worker(state):
+	# Masters are only reattached when the parent has published a new set since the last task
+	if getattr(light_local, "key", None)!=state["key"]:
+		attach_light_worker(state)
+	light_local.worker.light_path = state["light_path"]
+	return light_local.worker
+
+def reduce_light((state, filename)):
+	# The worker's stage timings for this frame travel back with the result
+	worker = current_light_worker(state)
+	result = worker.red_light_pool(filename)
+	return result, worker.instrument.collect()
+
+def reduce_light_chunk((state, blocks)):
+	worker = current_light_worker(state)
+	results = worker.red_light_blocks(blocks)
+	return results, worker.instrument.collect()
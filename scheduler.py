@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Picks the light worker count and chunk size from the frames about to be
+reduced and the memory there is to do it in.
+Each worker holds up to a chunk of raw frames in its read/write pipeline
+plus the working copies of the frame being corrected. Small lights of the
+same shape are corrected in blocks of up to BLOCK_BUDGET bytes, and then
+a block takes the place of a frame. The published masters are
+memory-mapped and shared, so they are only counted once. Workers are
+added until the cores or the memory budget run out; when not even one
+pipelined worker fits, chunks drop to one block at a time.
+
+Backends that copy the masters into every worker have that copy counted
+per worker instead, and the serial backend only ever has one.
+
+Anything set by hand (workers, chunk size, budget) is used as is, and the
+decision is returned with the numbers behind it so it can be reported.
+"""
+import numpy as np
+from multiprocessing import cpu_count
+
+MEMORY_FRACTION = 0.75
+WORKER_OVERHEAD = 96*2**20
+DEFAULT_CHUNKSIZE = 4
+BLOCK_BUDGET = 32*2**20
+
+def available_memory(meminfo="/proc/meminfo"):
+	# Bytes that can be used without swapping, or None where there's no /proc
+	try:
+		with open(meminfo) as f:
+			fields = dict((line.split(":")[0], int(line.split()[1])*1024) for line in f if len(line.split()) > 1)
+	except (IOError, ValueError):
+		return None
+	if "MemAvailable" in fields:
+		return fields["MemAvailable"]
+	if "MemFree" in fields:
+		return fields["MemFree"] + fields.get("Buffers", 0) + fields.get("Cached", 0)
+	return None
+
+def frame_geometry(frames):
+	# The largest (bitpix, npix) in the set, from the catalog's header fields
+	largest = None
+	for frame in frames:
+		if frame.get("bitpix")==None or frame.get("naxis1")==None or frame.get("naxis2")==None:
+			continue
+		geometry = (frame["bitpix"], frame["naxis1"]*frame["naxis2"])
+		if largest==None or abs(geometry[0])*geometry[1] > abs(largest[0])*largest[1]:
+			largest = geometry
+	return largest
+
+def work_dtype(bitpix, dtype):
+	# 32-bit integer and double lights are corrected in float64 whatever the precision
+	return np.dtype(np.float64 if bitpix in (32, -64) else dtype)
+
+def block_frames((bitpix, npix), dtype, budget=BLOCK_BUDGET):
+	# How many frames of this geometry are corrected together; big frames go one at a time
+	if not budget:
+		return 1
+	return int(max(1, budget // (work_dtype(bitpix, dtype).itemsize*npix)))
+
+def worker_memory((bitpix, npix), dtype, prefetch, write_behind, chunksize, frames=1):
+	# frames is how many of these frames are corrected together as one block
+	raw = abs(bitpix)/8*npix*frames
+	work = work_dtype(bitpix, dtype).itemsize*npix*frames
+	if chunksize > 1 and prefetch > 0:
+		# Blocks queued for or held by the reader and writer threads, on top of the one being corrected
+		in_flight = min(chunksize, prefetch + write_behind + 3)
+	else:
+		in_flight = 1
+	# The working copy and the output it's converted into, both reused from block to block
+	return WORKER_OVERHEAD + in_flight*raw + work + raw
+
+def schedule_lights(frames, shared, dtype, prefetch, write_behind, workers=None, chunksize=None, budget=None, block_budget=BLOCK_BUDGET,
+		copied=0, max_workers=None, reclaimable=0):
+	# copied is what each worker holds its own copy of, and max_workers what the backend can run at once.
+	# reclaimable is memory in use that the schedule accounts for itself (published masters, the running pool).
+	cpus = cpu_count()
+	available = available_memory()
+	if budget==None and available!=None:
+		budget = int((available + reclaimable)*MEMORY_FRACTION)
+	decision = {"workers":workers, "chunksize":chunksize if chunksize!=None else DEFAULT_CHUNKSIZE, "cpus":cpus,
+		"available":available, "reclaimable":reclaimable, "budget":budget, "shared":shared, "frame bytes":None, "block frames":None, "per worker":None, "limited by":"manual"}
+	geometry = frame_geometry(frames)
+	if geometry!=None:
+		decision["frame bytes"] = abs(geometry[0])/8*geometry[1]
+		decision["block frames"] = min(block_frames(geometry, dtype, block_budget), len(frames))
+		decision["per worker"] = worker_memory(geometry, dtype, prefetch, write_behind, decision["chunksize"], decision["block frames"]) + copied
+	if workers!=None:
+		pass
+	elif budget==None or geometry==None:
+		# Nothing to size against, so one worker per core
+		decision["workers"] = cpus
+		decision["limited by"] = "cpus"
+	else:
+		fit = (budget - shared)/decision["per worker"]
+		if fit < 1 and chunksize==None and decision["chunksize"] > 1:
+			decision["chunksize"] = 1
+			decision["per worker"] = worker_memory(geometry, dtype, prefetch, write_behind, 1, decision["block frames"]) + copied
+			fit = (budget - shared)/decision["per worker"]
+		decision["workers"] = int(max(1, min(cpus, fit)))
+		decision["limited by"] = "cpus" if fit >= cpus else "memory"
+	if max_workers!=None and decision["workers"] > max_workers:
+		decision["workers"] = max_workers
+		decision["limited by"] = "backend"
+	return decision
+
+def describe(decision):
+	text = "{} workers, chunks of {} ({}".format(decision["workers"], decision["chunksize"], decision["limited by"])
+	if "backend" in decision:
+		text = "{} backend, {}".format(decision["backend"], text)
+	if decision["per worker"]!=None:
+		text += ", {:.0f} MB per worker".format(decision["per worker"]/2.0**20)
+	if decision["budget"]!=None:
+		text += ", {:.0f} MB budget".format(decision["budget"]/2.0**20)
+	return text + ")"
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Publishes calibration arrays to a scratch directory (in /dev/shm when the
+system has it) so reduction workers can memory-map them read-only instead
+of each getting a pickled copy. publish() takes any nesting of dicts and
+swaps every array for a small file reference, so only the manifest has to
+cross the process boundary.
+"""
+import shutil
+import tempfile
+import numpy as np
+from os.path import isdir, join, getsize
+
+SCRATCH_ROOT = "/dev/shm" if isdir("/dev/shm") else None
+
+class sharedArray(object):
+	def __init__(self, filename):
+		self.filename = filename
+
+def store_tree(node, scratch, counter):
+	if isinstance(node, np.ndarray):
+		filename = join(scratch, "{}.npy".format(counter[0]))
+		counter[0] += 1
+		np.save(filename, node)
+		return sharedArray(filename)
+	if isinstance(node, dict):
+		return dict((key, store_tree(node[key], scratch, counter)) for key in node)
+	return node
+
+def load_tree(node):
+	if isinstance(node, sharedArray):
+		return np.load(node.filename, mmap_mode="r")
+	if isinstance(node, dict):
+		return dict((key, load_tree(node[key])) for key in node)
+	return node
+
+def publish(tree):
+	scratch = tempfile.mkdtemp(prefix="reducer-", dir=SCRATCH_ROOT)
+	return {"scratch":scratch, "tree":store_tree(tree, scratch, [0])}
+
+def attach(manifest):
+	return load_tree(manifest["tree"])
+
+def footprint(node):
+	# Bytes of array data in a published or in-memory tree
+	if isinstance(node, sharedArray):
+		return getsize(node.filename)
+	if isinstance(node, np.ndarray):
+		return node.nbytes
+	if isinstance(node, dict):
+		return sum(footprint(node[key]) for key in node)
+	return 0
+
+def release(manifest):
+	shutil.rmtree(manifest["scratch"], ignore_errors=True)
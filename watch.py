@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""
+Watch-folder mode: reduces light frames as they land in a directory.
+New files are picked up with inotify where the system has it, otherwise by
+polling. A file is only reduced once its size has stopped changing and
+matches what its FITS header says it should be. Frames are reduced with
+the loaded masters on the reducer's persistent worker pool, and the output
+goes to Corrected/ as with reducer.red_light.
+
+Runs without the curses menus too:
+	$ python watch.py /path/to/lights --masters /path/to/saved/masters
+"""
+import os
+import sys
+import time
+import select
+import struct
+import argparse
+import ctypes
+import ctypes.util
+from os import listdir, makedirs
+from os.path import join, exists, isfile, getsize, getmtime
+import reducer
+import fitshead
+from scheduler import describe
+from catalog import KEYWORDS
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+# How long stop() waits for frames already handed to the pool; a worker that died takes its frame with it
+STOP_TIMEOUT = 60.0
+
+def reduce_frame(task):
+	try:
+		return reducer.reduce_light(task)
+	except Exception as e:
+		return "{} not reduced - {}".format(task[1], e), None
+
+class inotify(object):
+	def __init__(self, path):
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		self.fd = libc.inotify_init()
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init failed")
+		if libc.inotify_add_watch(self.fd, path, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+			os.close(self.fd)
+			raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+	def wait(self, timeout):
+		names = []
+		if select.select([self.fd], [], [], timeout)[0]:
+			buf = os.read(self.fd, 64*1024)
+			offset = 0
+			while offset < len(buf):
+				wd, mask, cookie, length = struct.unpack_from("iIII", buf, offset)
+				names.append(buf[offset+16:offset+16+length].rstrip("\0"))
+				offset += 16 + length
+		return names
+
+	def close(self):
+		os.close(self.fd)
+
+class poller(object):
+	def __init__(self, path):
+		self.path = path
+		self.known = set(listdir(path))
+
+	def wait(self, timeout):
+		time.sleep(timeout)
+		current = set(listdir(self.path))
+		names = current - self.known
+		self.known = current
+		return list(names)
+
+	def close(self):
+		pass
+
+class watcher(object):
+	def __init__(self, datareducer, match=(None,None,None), workers=None, poll=1.0, backlog=False):
+		self.datareducer = datareducer
+		self.path = datareducer.light_path
+		self.match = match
+		self.workers = workers
+		self.poll = poll
+		self.backlog = backlog
+		self.pending = {}
+		self.submitted = {}
+		self.results = []
+		self.lost = []
+		self.pool = None
+		self.state = None
+		self.events = None
+
+	def start(self):
+		if not exists(join(self.path, "Corrected")):
+			makedirs(join(self.path, "Corrected"))
+		self.datareducer.update_cal()
+		lights = self.datareducer.scan(self.path).select("LIGHT", self.match)
+		pairs = set((frame["exposure"], frame["filter"]) for frame in lights if frame["exposure"]!=None and frame["filter"]!=None)
+		if self.workers!=None:
+			self.datareducer.light_workers = self.workers
+		# The reducer's own pool, so masters already published for red_light are reused
+		self.pool, self.state = self.datareducer.light_pool(pairs, lights)
+		try:
+			self.events = inotify(self.path)
+		except (OSError, AttributeError):
+			self.events = poller(self.path)
+		if self.backlog:
+			for frame in lights:
+				if not exists(join(self.path, "Corrected", frame["filename"])):
+					self.pending[frame["filename"]] = {"seen":time.time(), "size":None}
+
+	def stop(self, timeout=STOP_TIMEOUT):
+		# The pool belongs to the reducer, so just wait for the frames already handed to it
+		started = time.time()
+		while len(self.submitted)!=0 and time.time() - started < timeout:
+			time.sleep(0.05)
+		self.lost = sorted(self.submitted)
+		self.pool = None
+		if self.events!=None:
+			self.events.close()
+			self.events = None
+
+	def wanted(self, filename):
+		header = fitshead.getheader(join(self.path, filename), KEYWORDS)
+		if header.get("IMAGETYP")!="LIGHT":
+			return False
+		obj, exp, fil = self.match
+		if "EXPOSURE" in header:
+			exposure = str(header["EXPOSURE"])
+		elif "EXPTIME" in header:
+			exposure = str(header["EXPTIME"])
+		else:
+			exposure = None
+		return ((obj==None or header.get("OBJECT")==obj)
+			and (exp==None or exposure==None or exposure==exp)
+			and (fil==None or header.get("FILTER")==fil))
+
+	def check_pending(self):
+		# A file is complete once its size is what the header promises and hasn't moved since the last look
+		for filename in list(self.pending):
+			path = join(self.path, filename)
+			if not isfile(path):
+				del self.pending[filename]
+				continue
+			try:
+				size = getsize(path)
+			except OSError:
+				del self.pending[filename]
+				continue
+			previous = self.pending[filename]["size"]
+			self.pending[filename]["size"] = size
+			if size!=previous:
+				continue
+			try:
+				expected = fitshead.expected_size(path)
+			except (fitshead.unusualHeader, KeyError):
+				# A header this can't size (no BITPIX, say) is treated like one that isn't FITS
+				expected = None
+			except (IOError, OSError):
+				# Gone or unreadable since it was seen; a new event brings it back if it returns
+				del self.pending[filename]
+				continue
+			if expected==None:
+				del self.pending[filename]
+				continue
+			if size < expected:
+				continue
+			info = self.pending.pop(filename)
+			try:
+				if not self.wanted(filename):
+					continue
+			except (IOError, OSError, KeyError, Warning):
+				continue
+			info["ready"] = time.time()
+			info["mtime"] = getmtime(path)
+			self.submitted[filename] = info
+			self.pool.apply_async(reduce_frame, ((self.state, filename),), callback=self.__finished(filename))
+
+	def __finished(self, filename):
+		def callback((result, stats)):
+			if stats!=None:
+				self.datareducer.instrument.merge(stats)
+			info = self.submitted.pop(filename)
+			done = time.time()
+			self.results.append({"file":filename, "result":result, "latency":done - info["ready"], "since write":done - info["mtime"]})
+		return callback
+
+	def step(self, timeout=None):
+		for name in self.events.wait(self.poll if timeout==None else timeout):
+			if name.startswith(".") or name in self.submitted:
+				continue
+			self.pending[name] = {"seen":time.time(), "size":None}
+		self.check_pending()
+
+	def run(self, duration=None, report=None):
+		with self.datareducer.instrument.run("watch"):
+			self.start()
+			started = time.time()
+			reported = 0
+			try:
+				while duration==None or time.time() - started < duration:
+					self.step()
+					while report!=None and reported < len(self.results):
+						report(self.results[reported])
+						reported += 1
+			except KeyboardInterrupt:
+				pass
+			finally:
+				self.stop()
+		while report!=None and reported < len(self.results):
+			report(self.results[reported])
+			reported += 1
+		return self.metrics()
+
+	def metrics(self):
+		latencies = sorted(result["latency"] for result in self.results)
+		stats = {"frames":len(self.results), "in flight":len(self.submitted), "waiting":len(self.pending), "lost":len(self.lost)}
+		if len(latencies)!=0:
+			stats["latency mean"] = sum(latencies)/len(latencies)
+			stats["latency p50"] = latencies[len(latencies)/2]
+			stats["latency p95"] = latencies[min(len(latencies)-1, int(len(latencies)*0.95))]
+			stats["latency max"] = latencies[-1]
+			stats["since write max"] = max(result["since write"] for result in self.results)
+		return stats
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Reduce light frames as they are written to a directory.")
+	parser.add_argument("light_path")
+	parser.add_argument("--masters", help="directory of masters saved by save_calib")
+	parser.add_argument("--bias", help="directory of raw bias frames")
+	parser.add_argument("--dark", help="directory of raw dark frames")
+	parser.add_argument("--flat", help="directory of raw flat frames")
+	parser.add_argument("--object")
+	parser.add_argument("--exposure")
+	parser.add_argument("--filter")
+	parser.add_argument("--backend", default="shared", choices=reducer.BACKEND_NAMES, help="where frames are reduced, see backends.py")
+	parser.add_argument("--workers", type=int, help="default: as many as fit in memory")
+	parser.add_argument("--memory-budget", type=float, help="MB the workers may use (default: most of the free memory)")
+	parser.add_argument("--poll", type=float, default=1.0, help="seconds between checks for new files")
+	parser.add_argument("--backlog", action="store_true", help="also reduce lights already in the directory")
+	parser.add_argument("--duration", type=float, help="stop after this many seconds")
+	parser.add_argument("--report", help="append a JSON timing report to this file when done")
+	parser.add_argument("--compress", action="store_true", help="write tile-compressed FITS")
+	parser.add_argument("--quantize-level", type=float, help="quantize float output before compressing (lossy)")
+	args = parser.parse_args(argv)
+	datareducer = reducer.reducer()
+	datareducer.light_path = args.light_path
+	datareducer.instrument.report_path = args.report
+	datareducer.backend = args.backend
+	datareducer.compress = args.compress
+	datareducer.quantize_level = args.quantize_level
+	if args.memory_budget!=None:
+		datareducer.memory_budget = int(args.memory_budget*2**20)
+	if args.masters:
+		datareducer.load_calib(args.masters)
+	if args.bias:
+		datareducer.bias_path = args.bias
+		for error in datareducer.gen_bias():
+			sys.stderr.write(error + "\n")
+	if args.dark:
+		datareducer.dark_path = args.dark
+		for error in datareducer.gen_darks():
+			sys.stderr.write(error + "\n")
+	if args.flat:
+		datareducer.flat_path = args.flat
+		for error in datareducer.gen_flats():
+			sys.stderr.write(error + "\n")
+	for warning in datareducer.check_calib("ALL"):
+		sys.stderr.write(warning.replace(" Continue anyway?", "") + "\n")
+
+	def report(result):
+		print("{} ({:.2f}s)".format(result["result"], result["latency"]))
+		sys.stdout.flush()
+
+	folder = watcher(datareducer, (args.object, args.exposure, args.filter), args.workers, args.poll, args.backlog)
+	stats = folder.run(args.duration, report)
+	print("schedule: {}".format(describe(datareducer.schedule)))
+	for filename in folder.lost:
+		sys.stderr.write("{} not reduced - no result from its worker\n".format(filename))
+	datareducer.close()
+	for key in sorted(stats):
+		print("{}: {}".format(key, stats[key]))
+	return 0
+
+if __name__=="__main__":
+	sys.exit(main(sys.argv[1:]))